@@ -1,6 +1,8 @@
 import os
 import sys
+import mmap
 import collections
+import itertools
 import math
 import json
 from functools import reduce
@@ -13,8 +15,10 @@ from ase.utils import formula_metal
 from ase.io.vasp import __get_xml_parameter
 import copy
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from cathub.tools import clear_state, get_state, clear_prefactor, get_prefactor
 from cathub.cathubsqlite import CathubSQLite
+from cathub.ase_tools.parse_cache import ParseCache, CACHE_FILENAME
 from collections import OrderedDict
 
 from pathlib import Path
@@ -104,7 +108,36 @@ def symbols(atoms):
 def collect_structures(foldername,
                        verbose=False,
                        level='**/*',
-                       file_extensions=['']):
+                       file_extensions=[''],
+                       workers=1,
+                       cache=None,
+                       clear_cache=False,
+                       executor=None):
+    """
+    Read atomic structures from output files in folder
+
+    Parameters
+    ----------
+    foldername: str
+    verbose: bool
+    level: str
+        glob pattern for files, such as '**/*' or '*'
+    file_extensions: list of str
+    workers: int
+        Number of processes used to parse files. Structures are yielded
+        in the same (filename) order as with one process.
+    cache: str
+        Parse cache file (or folder to keep '.cathub_cache.db' in).
+        Files that did not change since they were cached are not read
+        again. None (default) reads all files.
+    clear_cache: bool
+        Invalidate the parse cache before reading.
+    executor: concurrent.futures.Executor
+        Process pool to parse files in, which is kept open for further
+        calls. By default a pool with workers processes is started for
+        this call. At most 2 * workers files are parsed ahead of the
+        structures yielded.
+    """
 
     if verbose:
         print(foldername)
@@ -112,8 +145,9 @@ def collect_structures(foldername,
     all_files = []
 
     for ext in file_extensions:
-        all_files += list(Path(foldername).glob(level + ext))
+        all_files += sorted(Path(foldername).glob(level + ext))
 
+    read_files = []
     for i, filename in enumerate(all_files):
         posix_filename = str(filename.as_posix())
         if verbose:
@@ -126,7 +160,8 @@ def collect_structures(foldername,
                 print('  -> ignore')
             continue
 
-        elif posix_filename.endswith('traj.old'):
+        elif posix_filename.endswith('traj.old') or \
+                os.path.basename(posix_filename).startswith(CACHE_FILENAME):
             if verbose:
                 print('  -> ignore')
             continue
@@ -138,124 +173,191 @@ def collect_structures(foldername,
                     print('  -> ignore')
                 continue
             if filetype in accepted_formats:
-                if filetype == 'db':
-                    with ase.db.connect(posix_filename) as db:
-                        count = db.count()
-                        print('Processing ASE db with {} structures'.format(count))
-                        for row in db.select('energy'):
-                            structure = row.toatoms()
-                            structure.info['filename'] = row.formula + \
-                                '@' + posix_filename
-                            structure.info['filetype'] = filetype
-                            yield structure
+                read_files += [(posix_filename, filetype)]
+
+    cached = {}
+    if cache is not None:
+        # one connection for all lookups and new entries of this call
+        cache = ParseCache(cache)
+        cache.open()
+        if clear_cache:
+            cache.clear()
+        for posix_filename, filetype in read_files:
+            if filetype == 'db':
+                continue
+            result = cache.get(posix_filename)
+            if result is not None:
+                cached[posix_filename] = result
+
+    n_read = len([1 for posix_filename, filetype in read_files
+                  if filetype != 'db' and posix_filename not in cached])
+    own_executor = False
+    if executor is None and workers > 1 and n_read > 1:
+        executor = ProcessPoolExecutor(max_workers=min(workers, n_read))
+        own_executor = True
+
+    def submit(posix_filename, filetype):
+        if executor is None or filetype == 'db' or \
+                posix_filename in cached:
+            return posix_filename, filetype, None
+        return posix_filename, filetype, executor.submit(
+            read_structure_file, posix_filename, filetype, verbose)
+
+    files = iter(read_files)
+    pending = collections.deque(
+        submit(*item) for item in itertools.islice(files, 2 * workers))
+    try:
+        while pending:
+            posix_filename, filetype, result = pending.popleft()
+            for item in itertools.islice(files, 1):
+                pending.append(submit(*item))
+            if filetype == 'db':
+                for structure in read_db_structures(posix_filename, filetype):
+                    yield structure
+                continue
+            if posix_filename in cached:
+                structures, messages = cached.pop(posix_filename)
+            else:
+                if result is None:
+                    structures, messages = read_structure_file(
+                        posix_filename, filetype, verbose)
                 else:
-                    try:
-                        basename = os.path.basename(
-                            posix_filename).split('.')[0]
-                        if basename == 'neb':  # all neb in same file
-                            structures = ase.io.read(posix_filename, ':')
-                            for k, s in enumerate(structures):
-                                s.info['filename'] = posix_filename
-                                s.info['neb_name'] = 'neb' + str(k)
-                                s.info['filetype'] = filetype
-
-                        else:
-                            structures = ase.io.read(posix_filename, '-1:')
-                            structures[-1].info['filename'] = posix_filename
-                            structures[-1].info['filetype'] = filetype
-                            if 'neb' in posix_filename:
-                                structures[-1].info['neb_name'] = posix_filename.split('/')[-1].split('.')[
-                                    0]
-
-                        # to be enforced soon
-                        # assert getattr(structures[-1], 'calc', None) != None, "No calculator"
-
-                        if getattr(structures[-1], 'calc', None) is None:
-                            if verbose:
-                                print("No calculator for structure {}".format(posix_filename))
-                            #structures[-1].calc = {'parameters':{}}
-
-                        elif structures[-1].calc.parameters == {}:
-                            vasprun_file = '/'.join(posix_filename.split('/')
-                                                    [:-1]) + '/vasprun.xml'
-                            if os.path.exists(vasprun_file):
-                                parameters = read_params_xml(
-                                    filename=vasprun_file)
-                                structures[-1].calc.parameters = parameters
-                            elif filetype == 'json':  # ASE doesn't read parameters from json :(
-                                parameters = json.load(open(posix_filename, 'r'))['1']\
-                                    .get('calculator_parameters', {})
-                                structures[-1].calc.parameters = parameters
-
-                                # to be enforced soon
-                                #assert getattr(structures[-1].calc, 'parameters', {}) != {}, "No calculator parameters"
-
-                        for s in structures:
-                            try:
-                                # ensure that the structure has an energy
-                                s.get_potential_energy()
-                                yield s
-                            except RuntimeError:
-                                if verbose:
-                                    print("Did not add {posix_filename} since it has no energy"
-                                          .format(
-                                              posix_filename=posix_filename,))
-                    except ET.ParseError:
-                        print("Couldn't read XML file {posix_filename}"
-                              .format(
-                                  posix_filename=posix_filename,
-                              ))
-                    except TypeError:
-                        print("Warning: Could not read {posix_filename}"
-                              .format(
-                                  posix_filename=posix_filename,
-                              ))
-
-                    except StopIteration:
-                        print("Warning: StopIteration {posix_filename} hit."
-                              .format(
-                                  posix_filename=posix_filename,
-                              ))
-                    except IndexError:
-                        print("Warning: File {posix_filename} looks incomplete"
-                              .format(
-                                  posix_filename=posix_filename,
-                              ))
-                    except OSError as e:
-                        print("Error with {posix_filename}: {e}".format(
-                            posix_filename=posix_filename,
-                            e=e,
-                        ))
-                    except AssertionError as e:
-                        print("Structure not accepted ({posix_filename}): {e}".format(
-                            posix_filename=posix_filename,
-                            e=e,
-                        ))
-                    except ValueError as e:
-                        print("Trouble reading {posix_filename}: {e}".format(
-                            posix_filename=posix_filename,
-                            e=e,
-                        ))
-                    except DeprecationWarning as e:
-                        print("Trouble reading {posix_filename}: {e}".format(
-                            posix_filename=posix_filename,
-                            e=e,
-                        ))
-                    except ImportError as e:
-                        print("Trouble reading {posix_filename}: {e}".format(
-                            posix_filename=posix_filename,
-                            e=e,
-                        ))
-                    except ase.io.formats.UnknownFileTypeError as e:
-                        print("Trouble reading {posix_filename}: {e}".format(
-                            posix_filename=posix_filename,
-                            e=e,
-                        ))
-                    except ase.io.ParseError as e:
-                        print("Trouble reading {posix_filename}: {e}".format(
-                            posix_filename=posix_filename,
-                            e=e,
-                        ))
+                    structures, messages = result.result()
+                if cache is not None:
+                    cache.set(posix_filename, structures, messages)
+            for message in messages:
+                print(message)
+            for s in structures:
+                yield s
+    finally:
+        for posix_filename, filetype, result in pending:
+            if result is not None:
+                result.cancel()
+        if own_executor:
+            executor.shutdown()
+        if cache is not None:
+            cache.close()
+
+
+def read_db_structures(posix_filename, filetype):
+    with ase.db.connect(posix_filename) as db:
+        count = db.count()
+        print('Processing ASE db with {} structures'.format(count))
+        for row in db.select('energy'):
+            structure = row.toatoms()
+            structure.info['filename'] = row.formula + \
+                '@' + posix_filename
+            structure.info['filetype'] = filetype
+            yield structure
+
+
+def read_structure_file(posix_filename, filetype, verbose=False):
+    """
+    Read structures with energies from one output file.
+
+    Returns list of structures and list of messages about the file, which
+    are printed by the caller so that they keep the file order when files
+    are read in parallel.
+    """
+    messages = []
+    read_structures = []
+    try:
+        basename = os.path.basename(
+            posix_filename).split('.')[0]
+        if basename == 'neb':  # all neb in same file
+            structures = ase.io.read(posix_filename, ':')
+            for k, s in enumerate(structures):
+                s.info['filename'] = posix_filename
+                s.info['neb_name'] = 'neb' + str(k)
+                s.info['filetype'] = filetype
+
+        else:
+            structures = None
+            if filetype == 'vasp-out':
+                atoms = read_outcar_final(posix_filename)
+                if atoms is not None:
+                    structures = [atoms]
+            if structures is None:
+                structures = ase.io.read(posix_filename, '-1:')
+            structures[-1].info['filename'] = posix_filename
+            structures[-1].info['filetype'] = filetype
+            if 'neb' in posix_filename:
+                structures[-1].info['neb_name'] = posix_filename.split('/')[-1].split('.')[
+                    0]
+
+        # to be enforced soon
+        # assert getattr(structures[-1], 'calc', None) != None, "No calculator"
+
+        if getattr(structures[-1], 'calc', None) is None:
+            if verbose:
+                messages += ["No calculator for structure {}".format(posix_filename)]
+            #structures[-1].calc = {'parameters':{}}
+
+        elif structures[-1].calc.parameters == {}:
+            vasprun_file = '/'.join(posix_filename.split('/')
+                                    [:-1]) + '/vasprun.xml'
+            if os.path.exists(vasprun_file):
+                parameters = read_params_xml(
+                    filename=vasprun_file)
+                structures[-1].calc.parameters = parameters
+            elif filetype == 'json':  # ASE doesn't read parameters from json :(
+                parameters = json.load(open(posix_filename, 'r'))['1']\
+                    .get('calculator_parameters', {})
+                structures[-1].calc.parameters = parameters
+
+                # to be enforced soon
+                #assert getattr(structures[-1].calc, 'parameters', {}) != {}, "No calculator parameters"
+
+        for s in structures:
+            try:
+                # ensure that the structure has an energy
+                s.get_potential_energy()
+                read_structures += [s]
+            except RuntimeError:
+                if verbose:
+                    messages += ["Did not add {posix_filename} since it has no energy"
+                                 .format(
+                                     posix_filename=posix_filename,)]
+    except ET.ParseError:
+        messages += ["Couldn't read XML file {posix_filename}"
+                     .format(
+                         posix_filename=posix_filename,
+                     )]
+    except TypeError:
+        messages += ["Warning: Could not read {posix_filename}"
+                     .format(
+                         posix_filename=posix_filename,
+                     )]
+
+    except StopIteration:
+        messages += ["Warning: StopIteration {posix_filename} hit."
+                     .format(
+                         posix_filename=posix_filename,
+                     )]
+    except IndexError:
+        messages += ["Warning: File {posix_filename} looks incomplete"
+                     .format(
+                         posix_filename=posix_filename,
+                     )]
+    except OSError as e:
+        messages += ["Error with {posix_filename}: {e}".format(
+            posix_filename=posix_filename,
+            e=e,
+        )]
+    except AssertionError as e:
+        messages += ["Structure not accepted ({posix_filename}): {e}".format(
+            posix_filename=posix_filename,
+            e=e,
+        )]
+    except (ValueError, DeprecationWarning, ImportError,
+            ase.io.formats.UnknownFileTypeError,
+            ase.io.ParseError) as e:
+        messages += ["Trouble reading {posix_filename}: {e}".format(
+            posix_filename=posix_filename,
+            e=e,
+        )]
+
+    return read_structures, messages
 
 
 def copy_atoms(atoms):
@@ -347,12 +449,14 @@ def debug_assert(expression, message, debug=False):
     return True
 
 
+critical_parameters = ['encut', 'ecut', 'ediff', 'ediffg',
+                       'kpts', 'gamma', 'ismear', 'sigma',
+                       'ispin']
+
+
 def compare_parameters(atoms1, atoms2):
     no_calc = False
 
-    critical_parameters = ['encut', 'ecut', 'ediff', 'ediffg',
-                           'kpts', 'gamma', 'ismear', 'sigma',
-                           'ispin']
     if not atoms1.calc or not atoms2.calc:
         return 2
 
@@ -360,75 +464,177 @@ def compare_parameters(atoms1, atoms2):
         return 2
 
     for k in critical_parameters:
-        v1 = atoms2.calc.parameters.get(k)
+        v1 = atoms1.calc.parameters.get(k)
         v2 = atoms2.calc.parameters.get(k)
 
         if not np.all(v1 == v2):
-            print('Parameter mismatch:', k, v, '!=', v2)
+            print('Parameter mismatch:', k, v1, '!=', v2)
             return 0
 
     return 1
 
 
-def read_params_xml(filename='vasprun.xml', index=-1):
+def get_parameter_key(atoms):
+    """Hashable key of the critical calculator parameters, so that
+    structures with equal keys pass compare_parameters. None if the
+    parameters are unknown."""
+    if not atoms.calc or not atoms.calc.parameters:
+        return None
+    return tuple(repr(np.asarray(atoms.calc.parameters.get(k)).tolist())
+                 for k in critical_parameters)
+
+
+OUTCAR_SCF_DELIM = b'FREE ENERGIE OF THE ION-ELECTRON SYSTEM'
+
+
+def _skip_lines(mm, pos, n):
+    """Position after the n'th newline from pos, None if file ends before"""
+    for i in range(n):
+        newline = mm.find(b'\n', pos)
+        if newline < 0:
+            if i == n - 1 and pos < len(mm):
+                return len(mm)
+            return None
+        pos = newline + 1
+    return pos
+
+
+def read_outcar_final(filename='OUTCAR'):
+    """
+    Reads the last complete ionic step from a VASP OUTCAR file.
+
+    Only the header and the block of the final step are parsed, found
+    by searching backwards in a memory map of the file, so memory use
+    does not grow with the number of ionic steps. The blocks are split
+    the same way as ase.io.vasp.read_vasp_out does. Returns None if
+    anything is missing, in which case the full ASE reader should be used.
+    """
+    try:
+        from ase.io.vasp_parsers import vasp_outcar_parsers
+    except ImportError:  # ase < 3.21
+        return None
+
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            iteration = mm.find(b'Iteration')
+            if iteration < 0:
+                return None
+            header_end = _skip_lines(mm, iteration, 1)
+            end = len(mm)
+            while True:
+                delim = mm.rfind(OUTCAR_SCF_DELIM, header_end, end)
+                if delim < 0:
+                    return None
+                # energies are in the 4 lines after the delimiter
+                chunk_end = _skip_lines(mm, delim, 5)
+                if chunk_end is not None:
+                    break
+                end = delim
+            previous = mm.rfind(OUTCAR_SCF_DELIM, header_end, delim)
+            if previous < 0:
+                chunk_start = header_end
+            else:
+                chunk_start = _skip_lines(mm, previous, 5)
+            try:
+                header_lines = mm[:header_end].decode().splitlines(True)
+                chunk_lines = mm[chunk_start:chunk_end].decode()\
+                    .splitlines(True)
+            except UnicodeDecodeError:
+                return None
+
+    try:
+        header = vasp_outcar_parsers.OutcarHeaderParser(
+            workdir=Path(filename).parent).build(header_lines)
+        atoms = vasp_outcar_parsers.OUTCARChunk(chunk_lines, header).build()
+    except (ase.io.ParseError, ValueError, IndexError, KeyError):
+        return None
+    return atoms
+
+
+def read_params_xml(filename='vasprun.xml', index=-1, read_kpoints=False):
     """
     Reads parameters from vasprun.xml file
     simplified version of ase.io.vasp functionality
+
+    Elements are cleared once they have been read, and parsing stops
+    as soon as incar, generator, kpoints generation and atominfo are
+    found, so the (large) calculation part of the file is never read.
+
+    Parameters
+    ----------
+    filename: str
+    read_kpoints: bool
+        Also read the list of irreducible kpoints and weights.
     """
     tree = ET.iterparse(filename, events=['start', 'end'])
-    atoms_init = None
-    calculation = []
-    ibz_kpts = None
-    kpt_weights = None
     parameters = {'kpoints': {}, 'generator': {}, 'incar': {}}  # OrderedDict()
-    try:
-        for event, elem in tree:
-            if event == 'end':
-                if elem.tag == 'kpoints':
-                    kpts = elem.findall("varray[@name='kpointlist']/v")
-                    weights = elem.findall("varray[@name='weights']/v")
-                    ibz_kpts = np.zeros((len(kpts), 3))
-                    weights_array = []
-                    for i, kpt in enumerate(kpts):
-                        ibz_kpts[i] = [float(val) for val in kpt.text.split()]
-                        weights_array += [weights[i].text.strip()]
-                    parameters['kpoints']['kpointlist'] = ibz_kpts.tolist()
-                    parameters['kpoints']['weights'] = weights_array
-                    for subelem in elem.iter(tag='generation'):
-                        kpts_params = {}
-                        parameters['kpoints']['generation'] = kpts_params
-                        for par in subelem.iter():
-                            if par.tag in ['v', 'i']:
-                                parname = par.attrib['name']
-                                kpts_params[parname] = __get_xml_parameter(par)
-
-                elif elem.tag in ['generator', 'incar']:
-                    for par in elem.iter():
-                        if par.tag in ['v', 'i']:
-                            parname = par.attrib['name']
-                            parameters[elem.tag][parname] = __get_xml_parameter(
-                                par)
-                elif elem.tag in ['atominfo']:
-                    psp_info = []
-                    for subelem in elem.iter():
-                        if subelem.attrib.get('name') == 'atomtypes':
-                            fieldnames = []
-                            for ss in subelem.iter(tag='field'):
-                                fieldnames += [ss.text]
-                            for ss in subelem.iter():
-                                if ss.tag == 'rc':
-                                    psp_info += [{}]
-                                    i = 0
-                                elif ss.tag == 'c':
-                                    psp_info[-1][fieldnames[i]
-                                                 ] = ss.text.strip()
-                                    i += 1
-
-                    parameters['psp_info'] = psp_info
-                    break
-    except ET.ParseError as parse_error:
+    missing = {'generator', 'incar', 'generation', 'atominfo'}
+    depth = 0
+    in_kpoints = False
+    for event, elem in tree:
+        if event == 'start':
+            depth += 1
+            if depth == 2 and elem.tag == 'kpoints':
+                in_kpoints = True
+            continue
+        depth -= 1
+
+        if in_kpoints:
+            if elem.tag == 'generation':
+                kpts_params = {}
+                parameters['kpoints']['generation'] = kpts_params
+                for par in elem.iter():
+                    if par.tag in ['v', 'i']:
+                        parname = par.attrib['name']
+                        kpts_params[parname] = __get_xml_parameter(par)
+                missing.discard('generation')
+                elem.clear()
+            elif read_kpoints and elem.tag == 'varray' and \
+                    elem.attrib.get('name') in ['kpointlist', 'weights']:
+                if elem.attrib['name'] == 'kpointlist':
+                    parameters['kpoints']['kpointlist'] = \
+                        [[float(val) for val in v.text.split()]
+                         for v in elem.iter(tag='v')]
+                else:
+                    parameters['kpoints']['weights'] = \
+                        [v.text.strip() for v in elem.iter(tag='v')]
+                elem.clear()
+            elif elem.tag == 'varray':
+                elem.clear()
+
+        if depth != 1:
+            continue
 
-        if atoms_init is None:
-            raise parse_error
-        return {}
+        if elem.tag == 'kpoints':
+            in_kpoints = False
+            missing.discard('generation')  # explicit kpoint list
+        elif elem.tag in ['generator', 'incar']:
+            for par in elem.iter():
+                if par.tag in ['v', 'i']:
+                    parname = par.attrib['name']
+                    parameters[elem.tag][parname] = __get_xml_parameter(
+                        par)
+        elif elem.tag in ['atominfo']:
+            psp_info = []
+            for subelem in elem.iter():
+                if subelem.attrib.get('name') == 'atomtypes':
+                    fieldnames = []
+                    for ss in subelem.iter(tag='field'):
+                        fieldnames += [ss.text]
+                    for ss in subelem.iter():
+                        if ss.tag == 'rc':
+                            psp_info += [{}]
+                            i = 0
+                        elif ss.tag == 'c':
+                            psp_info[-1][fieldnames[i]
+                                         ] = ss.text.strip()
+                            i += 1
+
+            parameters['psp_info'] = psp_info
+        missing.discard(elem.tag)
+        elem.clear()
+        if not missing:
+            break
     return parameters
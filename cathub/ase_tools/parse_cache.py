@@ -0,0 +1,163 @@
+import os
+import sqlite3
+from ase import Atoms
+from ase.calculators.singlepoint import SinglePointDFTCalculator
+from ase.io.jsonio import encode, decode
+
+CACHE_FILENAME = '.cathub_cache.db'
+
+# Files next to an output file that its parameters can be read from
+SIBLING_FILES = ['vasprun.xml']
+
+init_command = """CREATE TABLE IF NOT EXISTS structure_file (
+    path text PRIMARY KEY,
+    size integer,
+    mtime real,
+    siblings text,
+    data text
+    );"""
+
+
+def atoms_to_dict(atoms):
+    """Atoms with final energy, forces and calculator parameters as dict"""
+    dct = {'atoms': atoms.todict()}
+    calc = getattr(atoms, 'calc', None)
+    if calc is not None:
+        dct['calculator'] = {'name': getattr(calc, 'name', None),
+                             'results': getattr(calc, 'results', {}),
+                             'parameters': getattr(calc, 'parameters', {})}
+    return dct
+
+
+def dict_to_atoms(dct):
+    atoms = Atoms.fromdict(dct['atoms'])
+    calculator = dct.get('calculator')
+    if calculator is not None:
+        calc = SinglePointDFTCalculator(atoms, **calculator['results'])
+        if calculator['name']:
+            calc.name = calculator['name']
+        calc.parameters = calculator['parameters']
+        atoms.calc = calc
+    return atoms
+
+
+class ParseCache:
+    """
+    On-disk cache of structures read from output files.
+
+    Entries are keyed by absolute path, size and modification time,
+    so a file that changed on disk is read again. The same goes for
+    sibling files, such as a vasprun.xml next to an OUTCAR, which
+    parameters are read from.
+
+    Inside a with block, new entries are committed every
+    commit_interval files and when the block ends.
+
+    Parameters
+    ----------
+    filename: str
+        SQLite file for the cache. If a directory is given, the cache
+        is kept in a '.cathub_cache.db' file inside it.
+    commit_interval: int
+        Number of new entries written in one transaction
+    """
+
+    def __init__(self, filename, commit_interval=100):
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, CACHE_FILENAME)
+        self.filename = filename
+        self.commit_interval = commit_interval
+        self.connection = None
+        self.n_uncommitted = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def open(self):
+        """Keep one connection open for the following calls"""
+        self.connection = self._connect()
+
+    def close(self):
+        """Commit and close the connection"""
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+        self.n_uncommitted = 0
+
+    def _connect(self):
+        con = sqlite3.connect(self.filename, timeout=600)
+        cur = con.execute('PRAGMA table_info(structure_file)')
+        columns = [row[1] for row in cur.fetchall()]
+        if columns and 'siblings' not in columns:
+            # written before siblings were part of the key
+            con.execute('DROP TABLE structure_file')
+        con.execute(init_command)
+        return con
+
+    @staticmethod
+    def get_key(posix_filename):
+        """Absolute path, size, modification time and a string with
+        the size and modification time of sibling files"""
+        stat = os.stat(posix_filename)
+        dirname = os.path.dirname(os.path.abspath(posix_filename))
+        siblings = []
+        for sibling in SIBLING_FILES:
+            sibling_filename = os.path.join(dirname, sibling)
+            if sibling == os.path.basename(posix_filename) or \
+                    not os.path.exists(sibling_filename):
+                continue
+            sibling_stat = os.stat(sibling_filename)
+            siblings += ['{}:{}:{}'.format(sibling, sibling_stat.st_size,
+                                           sibling_stat.st_mtime)]
+        return (os.path.abspath(posix_filename), stat.st_size, stat.st_mtime,
+                ','.join(siblings))
+
+    def get(self, posix_filename):
+        """
+        Return (structures, messages) stored for file, or None
+        if the file is not in the cache or has changed.
+        """
+        con = self.connection or self._connect()
+        path, size, mtime, siblings = self.get_key(posix_filename)
+        cur = con.cursor()
+        cur.execute('SELECT size, mtime, siblings, data FROM structure_file '
+                    'WHERE path=?', [path])
+        row = cur.fetchone()
+        if self.connection is None:
+            con.close()
+        if row is None or list(row[:3]) != [size, mtime, siblings]:
+            return None
+        data = decode(row[3])
+        structures = [dict_to_atoms(dct) for dct in data['structures']]
+        return structures, data['messages']
+
+    def set(self, posix_filename, structures, messages):
+        con = self.connection or self._connect()
+        path, size, mtime, siblings = self.get_key(posix_filename)
+        data = encode({'structures': [atoms_to_dict(atoms)
+                                      for atoms in structures],
+                       'messages': messages})
+        con.execute('INSERT OR REPLACE INTO structure_file '
+                    '(path, size, mtime, siblings, data) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    [path, size, mtime, siblings, data])
+        if self.connection is None:
+            con.commit()
+            con.close()
+            return
+        self.n_uncommitted += 1
+        if self.n_uncommitted >= self.commit_interval:
+            con.commit()
+            self.n_uncommitted = 0
+
+    def clear(self):
+        """Invalidate all cached entries"""
+        con = self.connection or self._connect()
+        con.execute('DELETE FROM structure_file')
+        if self.connection is None:
+            con.commit()
+            con.close()
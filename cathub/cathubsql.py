@@ -1,11 +1,14 @@
-from sqlalchemy import create_engine
+from sqlalchemy import text
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pandas import read_sql
 import json
 import ase.db
 import ase.visualize
 
 from cathub.postgresql import CathubPostgreSQL
+from cathub.engines import get_engine
 
 
 class CathubSQL:
@@ -15,20 +18,23 @@ class CathubSQL:
 
     def __init__(self, filename=None, user='apiuser'):
 
+        self.schema = None
         if filename is not None:
             sql_url = 'sqlite:///' + str(filename)
             self.backend = 'sqlite'
         else:
-            sql_url = CathubPostgreSQL(user).server_name
+            db = CathubPostgreSQL(user)
+            sql_url = db.server_name
+            self.schema = db.schema
             self.backend = 'postgres'
 
         self.sql_url = sql_url
+        self.ase_url = sql_url.replace('sqlite:///', '')
 
         self.connection = None
 
     def _connect(self):
-        engine = create_engine(self.sql_url)
-        return engine.connect()
+        return get_engine(self.sql_url, schema=self.schema).connect()
 
     def __enter__(self):
         """Set connection upon entry using with statement"""
@@ -52,7 +58,10 @@ class CathubSQL:
                       products=None,
                       elements=None,
                       surface_composition=None,
-                      facet=None):
+                      facet=None,
+                      columns=None,
+                      chunksize=None,
+                      workers=1):
         """
         Get pandas dataframe containing reactions for dataset
 
@@ -77,144 +86,302 @@ class CathubSQL:
            Match a specific surface composition
         facet: str
            Match a specific surface facet
+        columns: list of str
+           Only query these columns, for example ['reaction_energy'].
+           Reaction table columns as well as 'atoms_name', 'atoms_id',
+           'doi' and 'equation' can be selected. reaction_id is always
+           included. Default is all columns.
+        chunksize: int
+           Return an iterator yielding dataframes with up to chunksize
+           reactions each, instead of a single dataframe.
+        workers: int
+           Number of threads used to fetch atomic structures
         """
+        query, params = self._get_dataframe_query(
+            columns=columns,
+            include_atoms=include_atoms,
+            pub_id=pub_id,
+            reactants=reactants,
+            products=products,
+            elements=elements,
+            surface_composition=surface_composition,
+            facet=facet)
+
+        if chunksize is not None:
+            return self._iter_dataframes(query, params, include_atoms,
+                                         chunksize, workers)
 
-        # Query SQL table to get reaction, publication, and structure info.
-        query = \
-            """SELECT r.*, rs.name, rs.ase_id, p.doi FROM reaction as r
-LEFT JOIN
-reaction_system as rs on r.id = rs.id
-LEFT JOIN
-publication as p on r.pub_id=p.pub_id"""
-
-        query += get_sql_query(backend=self.backend,
-                               pub_id=pub_id,
-                               reactants=reactants,
-                               products=products,
-                               elements=elements,
-                               surface_composition=surface_composition,
-                               facet=facet)
         con = self.connection or self._connect()
         print('Querying database\n')
-        dataframe = read_sql(query, con)
+        dataframe = read_sql(text(query), con, params=params)
         if self.connection is None:
             con.close()
 
         if len(dataframe) == 0:
             print('No reactions in database for {} -> {} and elements={}'
                   .format(reactants, products, elements))
-            print(query)
+            print(query, params)
             return dataframe
 
-        # load ase atoms objects to add to dataframe
-        if include_atoms:
-            atoms_list = []
-            id_to_atoms = {}
-            with ase.db.connect(self.sql_url.replace('sqlite:///', '')) as ase_db:
-                if isinstance(include_atoms, str):
-                    with ase.db.connect(include_atoms) as local_db:
-                        for id in set(dataframe['ase_id'].values):
-                            row = ase_db.get(unique_id=id)
-                            try:
-                                local_db.write(row, data=row.data)
-                            except sqlite3.IntegrityError:
-                                # pass if structure allready downloaded
-                                pass
-                else:
-                    for id in set(dataframe['ase_id'].values):
-                        row = ase_db.get(unique_id=id)
-                        atoms = row.toatoms()
-                        atoms.calc.parameters.update(row.calculator_parameters)
-                        atoms.info.update(row.key_value_pairs)
-                        atoms.data = row.data
-                        id_to_atoms[id] = atoms
-
-                    for id in dataframe['ase_id'].values:
-                        atoms_list += [id_to_atoms[id]]
-
-                    dataframe['atoms'] = atoms_list
-
-        # group by reaction id and aggregate structure columns to list
-        if 'textsearch' in dataframe.columns:
-            dataframe = dataframe.drop(columns=['textsearch'])
+        return self._format_dataframe(dataframe, include_atoms, workers)
 
-        dataframe = dataframe.rename(columns={'id': 'reaction_id',
-                                              'name': 'atoms_name',
-                                              'ase_id': 'atoms_id'}, index={'id': 'id'})
-
-        columns_group = {}
-
-        for c in dataframe.columns.values:
-            columns_group[c] = 'first'
-
-        if 'atoms_name' in dataframe.columns.values:
-            columns_group['atoms_name'] = list
-            columns_group['atoms_id'] = list
-        if include_atoms == True:
-            columns_group['atoms'] = list
+    def _iter_dataframes(self, query, params, include_atoms, chunksize,
+                         workers=1):
+        con = self.connection or self._connect()
+        print('Querying database\n')
+        try:
+            for dataframe in read_sql(text(query), con, params=params,
+                                      chunksize=chunksize):
+                yield self._format_dataframe(dataframe, include_atoms,
+                                             workers)
+        finally:
+            if self.connection is None:
+                con.close()
+
+    def _get_dataframe_query(self, columns=None, include_atoms=False,
+                            **kwargs):
+        """SQL query and bind parameters for get_dataframe. Structure
+        names and ids are aggregated to one row per reaction in SQL"""
+        if columns is None:
+            select = ['r.*', 'atoms_name', 'atoms_id', 'p.doi']
+        else:
+            columns = list(columns)
+            if include_atoms and 'atoms_id' not in columns:
+                columns += ['atoms_id']
+            if 'equation' in columns:
+                columns.remove('equation')
+                columns += [c for c in ['reactants', 'products']
+                            if c not in columns]
+            select = ['r.id']
+            for column in columns:
+                if column in ['atoms_name', 'atoms_id']:
+                    select += [column]
+                elif column == 'doi':
+                    select += ['p.doi']
+                elif column not in ['id', 'reaction_id']:
+                    select += ['r.' + column]
+
+        if self.backend == 'postgres':
+            aggregate = 'array_agg'
+        else:
+            aggregate = 'json_group_array'
+        select = [{'atoms_name': '{}(rs.name) as atoms_name',
+                   'atoms_id': '{}(rs.ase_id) as atoms_id'}
+                  .get(c, c).format(aggregate) for c in select]
+
+        aggregated = any(['atoms_' in c for c in select])
+        query = 'SELECT ' + ', '.join(select) + ' FROM reaction as r'
+        # only join the tables needed for the selected columns
+        if aggregated:
+            query += '\nLEFT JOIN\nreaction_system as rs on r.id = rs.id'
+        if 'p.doi' in select:
+            query += '\nLEFT JOIN\npublication as p on r.pub_id=p.pub_id'
+
+        where, params = get_sql_query(
+            backend=self.backend,
+            elements_column=self._has_elements_column(),
+            **kwargs)
+        query += where
+        if aggregated:
+            query += ' \nGROUP BY r.id'
+            if 'p.doi' in select:
+                query += ', p.doi'
+        query += ' \nORDER BY r.id'
+
+        return query, params
+
+    def _has_elements_column(self):
+        """Whether the reaction table has the indexed elements column,
+        which is only the case on Postgres"""
+        if self.backend != 'postgres':
+            return False
+        if getattr(self, 'elements_column', None) is None:
+            con = self.connection or self._connect()
+            result = con.execute(text(
+                """SELECT count(*) FROM information_schema.columns
+                WHERE table_name = 'reaction'
+                AND column_name = 'elements'
+                AND table_schema = current_schema()"""))
+            self.elements_column = result.fetchone()[0] > 0
+            if self.connection is None:
+                con.close()
+        return self.elements_column
+
+    def _format_dataframe(self, dataframe, include_atoms=False, workers=1):
+        for column in ['textsearch', 'fingerprint', 'elements']:
+            if column in dataframe.columns:
+                dataframe = dataframe.drop(columns=[column])
+
+        dataframe = dataframe.rename(columns={'id': 'reaction_id'})
+
+        # structure lists are json arrays in SQLite
+        for column in ['atoms_name', 'atoms_id']:
+            if column in dataframe.columns and self.backend == 'sqlite':
+                dataframe[column] = [json.loads(value) for value in
+                                     dataframe[column].values]
 
-        dataframe = dataframe.groupby(['reaction_id'])\
-                             .agg(columns_group).reset_index(drop=True)
+        # load ase atoms objects to add to dataframe
+        if include_atoms:
+            ids = set([id for atoms_ids in dataframe['atoms_id'].values
+                       for id in atoms_ids if id is not None])
+            id_to_row = get_atoms_rows(self.ase_url, ids, workers=workers)
+            if isinstance(include_atoms, str):
+                with ase.db.connect(include_atoms) as local_db:
+                    for row in id_to_row.values():
+                        try:
+                            local_db.write(row, data=row.data)
+                        except sqlite3.IntegrityError:
+                            # pass if structure allready downloaded
+                            pass
+            else:
+                id_to_atoms = dict([(id, row_to_atoms(row))
+                                    for id, row in id_to_row.items()])
+                dataframe['atoms'] = [
+                    [id_to_atoms[id] for id in atoms_ids if id is not None]
+                    for atoms_ids in dataframe['atoms_id'].values]
 
-        equations = []
-        for reactants, products in dataframe[['reactants', 'products']].values:
-            equations += [get_equation(reactants, products)]
+        if 'reactants' in dataframe.columns and \
+                'products' in dataframe.columns:
+            equations = []
+            for reactants, products in \
+                    dataframe[['reactants', 'products']].values:
+                equations += [get_equation(reactants, products)]
 
-        dataframe['equation'] = equations
+            dataframe['equation'] = equations
 
         return dataframe
 
     def get_atoms_for_reaction(self, reaction_id):
         con = self.connection or self._connect()
         print('Querying database')
-        query = "select ase_id from reaction_system where id='{}'".format(
-            reaction_id)
-
-        ids = con.execute(query)
+        query = text('select ase_id from reaction_system where id=:id')
+        ids = [row[0] for row in con.execute(query, {'id': reaction_id})]
         if self.connection is None:
             con.close()
 
-        atoms_list = []
-        with ase.db.connect(self.sql_url) as ase_db:
-            for unique_id in ids:
-                for row in ase_db.select(unique_id=unique_id[0]):
-                    atoms_list += [row.toatoms()]
-
-        return atoms_list
+        return self.get_atoms_for_id(ids)
 
     def get_atoms_for_publication(self, pub_id):
         atoms_list = []
-        with ase.db.connect(self.sql_url) as ase_db:
+        with ase.db.connect(self.ase_url) as ase_db:
             total = ase_db.count('pub_id={}'.format(pub_id))
             print('Fetching {} atomic structures'.format(total))
             for i, row in enumerate(ase_db.select('pub_id={}'.format(pub_id))):
                 if (i+1) % 10 == 0:
                     print('  {}/{}'.format(i+1, total))
-                atoms = row.toatoms()
-                atoms.calc.parameters.update(row.calculator_parameters)
-                atoms.info.update(row.key_value_pairs)
-                atoms.data = row.data
-                atoms_list += [atoms]
+                atoms_list += [row_to_atoms(row)]
 
         return atoms_list
 
-    def get_atoms_for_id(self, atoms_id=None):
-        """Get atoms for atoms_id"""
+    def get_atoms_for_id(self, atoms_id=None, workers=1):
+        """Get atoms for atoms_id
+
+        atoms_id: str or list of str
+           unique_id of structures
+        workers: int
+           Number of threads used to fetch structures
+        """
 
         if not isinstance(atoms_id, list):
             atoms_id = [atoms_id]
 
-        atoms_list = []
-        with ase.db.connect(self.sql_url) as ase_db:
-            for unique_id in atoms_id:
-                for row in ase_db.select(unique_id=unique_id):
-                    atoms = row.toatoms()
-                    atoms.calc.parameters.update(row.calculator_parameters)
-                    atoms.info.update(row.key_value_pairs)
-                    atoms.data = row.data
-                    atoms_list += [atoms]
+        id_to_row = get_atoms_rows(self.ase_url, atoms_id, workers=workers)
 
-        return atoms_list
+        return [row_to_atoms(id_to_row[unique_id]) for unique_id in atoms_id
+                if unique_id in id_to_row]
+
+
+def get_atoms_rows(ase_url, unique_ids, chunksize=1000, workers=1):
+    """Fetch ASE rows for many structures, with one query per chunk
+    of unique_ids.
+
+    Parameters:
+
+    ase_url: str
+       ASE db filename or postgresql:// url
+    unique_ids: list of str
+    chunksize: int
+       number of structures per query
+    workers: int
+       number of threads, each with its own connection, used to
+       fetch chunks in parallel
+
+    Returns dict of unique_id: AtomsRow
+    """
+    unique_ids = list(set(unique_ids))
+    chunks = [unique_ids[i: i + chunksize]
+              for i in range(0, len(unique_ids), chunksize)]
+
+    id_to_row = {}
+    if workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for rows in executor.map(
+                    lambda chunk: _get_atoms_rows_chunk(ase_url, chunk),
+                    chunks):
+                id_to_row.update(rows)
+    else:
+        for chunk in chunks:
+            id_to_row.update(_get_atoms_rows_chunk(ase_url, chunk))
+
+    return id_to_row
+
+
+_ase_databases = {}
+_ase_databases_lock = threading.Lock()
+
+
+def _get_ase_database(ase_url):
+    """ASE database for url, shared by all threads. It is initialized
+    once, after which rows read on other connections can be converted
+    without opening a connection of its own"""
+    with _ase_databases_lock:
+        ase_db = _ase_databases.get(ase_url)
+        if ase_db is None:
+            ase_db = ase.db.connect(ase_url)
+            with ase_db.managed_connection():
+                pass  # reads the version of the database format
+            _ase_databases[ase_url] = ase_db
+    return ase_db
+
+
+def _get_atoms_rows_chunk(ase_url, unique_ids):
+    """ASE rows for unique_ids, read with one query on a connection
+    from the shared pool of get_engine"""
+    ase_db = _get_ase_database(ase_url)
+    # the systems columns up to data make up the row tuple of ASE
+    n_columns = ase_db.columnnames.index('data') + 1
+    columns = ', '.join(['systems.' + c
+                         for c in ase_db.columnnames[:n_columns]])
+    if ase_url.startswith('postgresql://'):
+        engine = get_engine(ase_url)
+        where = 'unique_id = ANY(%s)'
+        args = [unique_ids]
+    else:
+        engine = get_engine('sqlite:///' + ase_url)
+        where = 'unique_id IN ({})'.format(
+            ', '.join(['?'] * len(unique_ids)))
+        args = unique_ids
+    con = engine.raw_connection()
+    try:
+        cur = con.cursor()
+        cur.execute('SELECT {} FROM systems WHERE {}'.format(
+            columns, where), args)
+        values = cur.fetchall()
+    finally:
+        con.close()
+    rows = [ase_db._convert_tuple_to_row(tuple(row_values))
+            for row_values in values]
+    return dict([(row.unique_id, row) for row in rows])
+
+
+def row_to_atoms(row):
+    """Atoms from ASE row with calculator parameters, key_value_pairs as
+    info and data"""
+    atoms = row.toatoms()
+    atoms.calc.parameters.update(row.calculator_parameters)
+    atoms.info.update(row.key_value_pairs)
+    atoms.data = row.data
+    return atoms
 
 
 def get_sql_query(backend='postgres',
@@ -223,71 +390,94 @@ def get_sql_query(backend='postgres',
                   products=None,
                   elements=None,
                   surface_composition=None,
-                  facet=None):
-    query = ''
+                  facet=None,
+                  elements_column=False):
+    """
+    WHERE clause for reaction table (as r), using bind parameters so that
+    the query text only depends on which filters are used.
+
+    elements_column: bool
+       Filter elements with the GIN indexed elements array of the
+       Postgres reaction table, instead of matching chemical_composition.
+
+    Returns query string and dict of parameters
+    """
+    conditions = []
+    params = {}
+
+    def add_param(value):
+        name = 'p{}'.format(len(params))
+        params[name] = value
+        return ':' + name
 
     if pub_id is not None:
-        query += " \nWHERE r.pub_id='{}'".format(pub_id)
+        conditions += ['r.pub_id = {}'.format(add_param(pub_id))]
 
     reaction_side = ['reactants', 'products']
     for i, reactant_list in enumerate([reactants, products]):
-        if reactant_list is not None:
-            if isinstance(reactant_list, list):
-                reactant_list = dict([(r, None) for r in reactant_list])
-            if not 'WHERE' in query:
-                query += ' \nWHERE '
+        if reactant_list is None:
+            continue
+        if isinstance(reactant_list, list):
+            reactant_list = dict([(r, None) for r in reactant_list])
+        for species, count in reactant_list.items():
+            species = species.replace(
+                '*', 'star').replace('(g)', 'gas')
+            column = 'r.' + reaction_side[i]
+            if backend == 'postgres':
+                if count is not None:
+                    conditions += ['({} ->> {})::float = {}'.format(
+                        column, add_param(species), add_param(count))]
+                else:
+                    conditions += ['{} ? {}'.format(
+                        column, add_param(species))]
             else:
-                query += ' \nAND '
-            query_list = []
-            for species, count in reactant_list.items():
-                species = species.replace(
-                    '*', 'star').replace('(g)', 'gas')
-                if backend == 'postgres':
-                    if count is not None:
-                        query_list += ["(r.{} ->>'{}')::float = {}".format(
-                                    reaction_side[i], species, count)]
-                    else:
-                        query_list += ["r.{} ? '{}'".format(
-                                    reaction_side[i], species)]
+                path = add_param('$."{}"'.format(species))
+                if count is not None:
+                    conditions += ['json_extract({}, {}) = {}'.format(
+                        column, path, add_param(count))]
                 else:
-                    if count is not None:
-                        query_list += ["""json_extract(r.{}, '$.{}')={}""".format(
-                            reaction_side[i], species, count)]
-                    else:
-                        query_list += ["""json_extract(r.{}, '$.{}') is not null""".format(
-                            reaction_side[i], species, count)]
-
-            query += ' AND '.join(query_list)
+                    conditions += ['json_extract({}, {}) is not null'.format(
+                        column, path)]
+
     if elements is not None:
-        if not 'WHERE' in query:
-            query += ' \nWHERE '
+        include = [e for e in elements if e[0] != '-']
+        exclude = [e[1:] for e in elements if e[0] == '-']
+        if elements_column:
+            if include:
+                conditions += ['r.elements @> CAST({} AS text[])'.format(
+                    add_param(include))]
+            if exclude:
+                conditions += ['NOT r.elements && CAST({} AS text[])'.format(
+                    add_param(exclude))]
         else:
-            query += ' \nAND '
-        query_list = []
-        for e in elements:
-            if e[0] == '-':
-                e = e[1:]
-                query_list += [
-                    "r.chemical_composition not like '%%{}%%'".format(e)]
-            else:
-                query_list += [
-                    "r.chemical_composition like '%%{}%%'".format(e)]
-        query += ' \nAND '.join(query_list)
+            # element symbol not followed by a lower case letter
+            for e in elements:
+                if e[0] == '-':
+                    e = e[1:]
+                    operator = 'NOT '
+                else:
+                    operator = ''
+                if backend == 'postgres':
+                    conditions += ['{}r.chemical_composition ~ {}'.format(
+                        operator, add_param(e + '([^a-z]|$)'))]
+                else:
+                    conditions += [
+                        "{}(r.chemical_composition || ' ') GLOB {}".format(
+                            operator, add_param('*' + e + '[^a-z]*'))]
+
     if surface_composition is not None:
-        if not 'WHERE' in query:
-            query += ' \nWHERE '
-        else:
-            query += ' \nAND '
-        query += " (r.surface_composition = '{}' or surface_composition like '{}-%%')"\
-            .format(surface_composition, surface_composition)
+        conditions += ['(r.surface_composition = {} or '
+                       'r.surface_composition like {})'.format(
+                           add_param(surface_composition),
+                           add_param(surface_composition + '-%'))]
     if facet is not None:
-        if not 'WHERE' in query:
-            query += ' \nWHERE '
-        else:
-            query += ' \nAND '
-        query += "r.facet like '{}%%'".format(facet)
+        conditions += ['r.facet like {}'.format(add_param(facet + '%'))]
+
+    query = ''
+    if conditions:
+        query = ' \nWHERE ' + ' \nAND '.join(conditions)
 
-    return query
+    return query, params
 
 
 def get_equation(reactants, products):
@@ -3,11 +3,18 @@ import os
 from ase.db.sqlite import SQLite3Database
 import sqlite3
 import json
+import zlib
+import hashlib
 from past.utils import PY2
 from tabulate import tabulate
 import ase
 import numpy as np
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 init_commands = [
     """ CREATE TABLE publication (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -45,6 +52,7 @@ init_commands = [
     dft_functional text,
     username text,
     pub_id text,
+    fingerprint text,
     FOREIGN KEY (pub_id) REFERENCES publication(pub_id)
     );""",
 
@@ -57,15 +65,43 @@ init_commands = [
     FOREIGN KEY (id) REFERENCES reaction(id)
     );""",
 
+    """CREATE TABLE log_blob (
+    hash text PRIMARY KEY,
+    codec text,
+    logfile BLOB
+    )""",
+
     """CREATE TABLE log (
     ase_id text,
     logtype text,
     logfile BLOB,
-    FOREIGN KEY (ase_id) REFERENCES systems(unique_id)
+    codec text,
+    hash text,
+    FOREIGN KEY (ase_id) REFERENCES systems(unique_id),
+    FOREIGN KEY (hash) REFERENCES log_blob(hash)
     )""",
 
+    """CREATE TABLE log_source (
+    path text PRIMARY KEY,
+    size integer,
+    mtime real,
+    hash text REFERENCES log_blob(hash)
+    )""",
     ]
 
+log_codecs = ['zstd', 'zlib', None]
+
+index_statements = [
+    'CREATE INDEX idxreacten ON reaction (reaction_energy);',
+    'CREATE INDEX idxchemcomp ON reaction (chemical_composition, '
+    'reaction_energy);',
+    'CREATE INDEX idxreact ON reaction (chemical_composition, reactants, '
+    'products);',
+    'CREATE INDEX idxfingerprint ON reaction (fingerprint);',
+    'CREATE INDEX idxreactsys ON reaction_system (id);',
+    'CREATE INDEX idxtextvalue ON text_key_values (key, value);'
+]
+
 
 class CathubSQLite:
     """Class for managing SQLite3 database for reaction energies,
@@ -105,12 +141,24 @@ class CathubSQLite:
         self.initialized = False
         self.default = 'NULL'
         self.connection = None
+        self.db_ase = None
         self.stdin = stdin
         self.stdout = stdout
 
     def _connect(self):
         return sqlite3.connect(self.filename, timeout=600)
 
+    def _get_ase_db(self):
+        """ASE db sharing the connection of the with block, so that it is
+        only set up once"""
+        if self.connection is None:
+            return ase.db.connect(self.filename)
+        if self.db_ase is None:
+            self.db_ase = ase.db.connect(self.filename)
+            self.db_ase.connection = self.connection
+            self.db_ase.change_count = 0
+        return self.db_ase
+
     def __enter__(self):
         """Set connection upon entry using with statement"""
         assert self.connection is None
@@ -125,6 +173,7 @@ class CathubSQLite:
             self.connection.rollback()
         self.connection.close()
         self.connection = None
+        self.db_ase = None
 
     def _initialize(self, con):
         """Set up tables in SQL"""
@@ -139,10 +188,80 @@ class CathubSQLite:
         if cur.fetchone()[0] == 0:  # no reaction table
             for init_command in init_commands:
                 con.execute(init_command)  # Create tables
+            for statement in index_statements:
+                con.execute(statement)
             con.commit()
+        else:
+            cur = con.execute(
+                'SELECT COUNT(*) FROM sqlite_master WHERE name="idxtextvalue"')
+            if cur.fetchone()[0] == 0:  # for structure fingerprint lookup
+                self._migrate_structures(con)
+            cur = con.execute('PRAGMA table_info(reaction)')
+            if 'fingerprint' not in [row[1] for row in cur.fetchall()]:
+                self._migrate(con)
+            cur = con.execute('PRAGMA table_info(log)')
+            log_columns = [row[1] for row in cur.fetchall()]
+            if 'hash' not in log_columns:
+                self._migrate_log(con, log_columns)
 
         self.initialized = True
 
+    def _migrate_log(self, con, log_columns):
+        """Add the tables and columns for compressed and deduplicated
+        logs. Logs written before are kept in the log table as they are"""
+        for init_command in init_commands[-3:]:
+            con.execute(init_command.replace('CREATE TABLE',
+                                             'CREATE TABLE IF NOT EXISTS'))
+        if log_columns:
+            for column in ['codec', 'hash']:
+                if column not in log_columns:
+                    con.execute('ALTER TABLE log ADD COLUMN {} text'
+                                .format(column))
+        con.commit()
+
+    def _migrate_structures(self, con):
+        """Add the structure_fingerprint key to structures written
+        before it was used, and the index to look it up"""
+        cur = con.execute("""SELECT id FROM systems WHERE id NOT IN
+        (SELECT id FROM text_key_values WHERE key='structure_fingerprint')""")
+        ids = [row[0] for row in cur.fetchall()]
+        con.commit()
+        if ids:
+            self.stdout.write('Adding fingerprints to {} structures\n'
+                              .format(len(ids)))
+            db_ase = ase.db.connect(self.filename)
+            with db_ase:
+                for id in ids:
+                    row = db_ase.get(id)
+                    if row.get('energy') is None:
+                        continue
+                    db_ase.update(id, structure_fingerprint=
+                                  get_structure_fingerprint(row.toatoms()))
+        con.execute(index_statements[-1])
+        con.commit()
+
+    def _migrate(self, con):
+        """Update reaction table written with an older schema: add the
+        fingerprint column and the indexes used for duplicate checks"""
+        self.stdout.write('Updating {} to current schema\n'
+                          .format(self.filename))
+        con.execute('ALTER TABLE reaction ADD COLUMN fingerprint text')
+        cur = con.execute(
+            """SELECT id, chemical_composition, facet, sites, reactants,
+            products, reaction_energy FROM reaction""")
+        fingerprints = []
+        for row in cur.fetchall():
+            values = dict(zip(['chemical_composition', 'facet', 'sites',
+                               'reactants', 'products', 'reaction_energy'],
+                              row[1:]))
+            fingerprints.append((get_reaction_fingerprint(values), row[0]))
+        con.executemany('UPDATE reaction SET fingerprint=? WHERE id=?',
+                        fingerprints)
+        for statement in index_statements:
+            con.execute(statement.replace('CREATE INDEX',
+                                          'CREATE INDEX IF NOT EXISTS'))
+        con.commit()
+
     def read(self, id, table='reaction'):
         """ Return an entire row of a table
         Parameters
@@ -176,9 +295,12 @@ class CathubSQLite:
         row = cur.fetchall()
         ase_id = row[0][0]
 
-        cur.execute('SELECT * FROM \n log \n WHERE \n ase_id="{}"'.format(
-            ase_id))
-        rows = cur.fetchall()
+        cur.execute("""SELECT l.ase_id, l.logtype,
+        coalesce(l.logfile, b.logfile), coalesce(l.codec, b.codec)
+        FROM log AS l LEFT JOIN log_blob AS b ON l.hash = b.hash
+        WHERE l.ase_id=?""", [ase_id])
+        rows = [(ase_id, logtype, decompress_log(logfile, codec))
+                for ase_id, logtype, logfile, codec in cur.fetchall()]
 
         return rows
 
@@ -229,21 +351,167 @@ class CathubSQLite:
 
         return pid
 
-    def write_log(self, ase_id, logtype, blob):
+    def write_log(self, ase_id, logtype, blob, codec='default'):
+        """
+        Write output file to the log table.
+
+        File contents are stored once in the log_blob table, keyed by
+        their BLAKE2 hash, and referenced from the log table.
+
+        Parameters
+        ----------
+        ase_id: str
+            unique_id of the structure
+        logtype: str
+            name of output file, such as 'OUTCAR'
+        blob: bytes
+            file content
+        codec: 'zstd', 'zlib' or None
+            compression of the stored blob. By default zstd is used
+            when the zstandard package is installed, otherwise zlib.
+
+        Returns the hash of the content
+        """
         con = self.connection or self._connect()
         self._initialize(con)
         cur = con.cursor()
 
-        values = (ase_id, blob)
-        insert_statement = """INSERT INTO
-        log(ase_id, logtype, logfile) VALUES (?, ?, ?)"""
+        hash = get_log_hash(blob)
+        self._write_log_blob(cur, hash, blob, codec)
+        self._write_log_reference(cur, ase_id, logtype, hash)
+
+        if self.connection is None:
+            con.commit()
+            con.close()
 
-        cur.execute(insert_statement, [ase_id, logtype, blob])
+        return hash
+
+    def write_log_file(self, ase_id, logtype, filename, codec='default'):
+        """
+        Write output file to the log table, see write_log.
+
+        The file is only read if its path, size and modification time
+        do not match a file stored before.
+
+        Returns the hash of the content
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        cur.execute("""SELECT s.hash FROM log_source AS s
+        JOIN log_blob AS b ON s.hash = b.hash
+        WHERE s.path=? AND s.size=? AND s.mtime=?""",
+                    [path, stat.st_size, stat.st_mtime])
+        row = cur.fetchone()
+        if row is not None:
+            hash = row[0]
+        else:
+            with open(filename, 'rb') as file:
+                blob = file.read()
+            hash = get_log_hash(blob)
+            self._write_log_blob(cur, hash, blob, codec)
+            cur.execute("""INSERT OR REPLACE INTO
+            log_source(path, size, mtime, hash) VALUES (?, ?, ?, ?)""",
+                        [path, stat.st_size, stat.st_mtime, hash])
+        self._write_log_reference(cur, ase_id, logtype, hash)
 
         if self.connection is None:
             con.commit()
             con.close()
 
+        return hash
+
+    def _write_log_blob(self, cur, hash, blob, codec='default'):
+        cur.execute('SELECT count(*) FROM log_blob WHERE hash=?', [hash])
+        if cur.fetchone()[0] > 0:  # already stored
+            return
+        codec, blob = compress_log(blob, codec)
+        cur.execute('INSERT INTO log_blob(hash, codec, logfile) '
+                    'VALUES (?, ?, ?)', [hash, codec, blob])
+
+    def _write_log_reference(self, cur, ase_id, logtype, hash):
+        cur.execute('SELECT count(*) FROM log '
+                    'WHERE ase_id=? AND logtype=? AND hash=?',
+                    [ase_id, logtype, hash])
+        if cur.fetchone()[0] > 0:
+            return
+        # One log of each type per structure, a new file replaces the old
+        cur.execute('DELETE FROM log WHERE ase_id=? AND logtype=?',
+                    [ase_id, logtype])
+        cur.execute('INSERT INTO log(ase_id, logtype, hash) VALUES (?, ?, ?)',
+                    [ase_id, logtype, hash])
+
+    def compress_logs(self, codec='default'):
+        """
+        Store existing logs compressed with codec and deduplicated,
+        such as raw logs in files written by older versions of cathub.
+
+        Returns the number of updated logs.
+        """
+        if codec == 'default':
+            codec = default_codec()
+        assert codec in log_codecs, 'unknown codec {}'.format(codec)
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+
+        # logs stored in the log table itself, and blobs with another codec
+        cur.execute('SELECT rowid FROM log WHERE logfile IS NOT NULL '
+                    'ORDER BY rowid')
+        log_rowids = [row[0] for row in cur.fetchall()]
+        cur.execute('SELECT rowid FROM log_blob WHERE codec IS NOT ? '
+                    'ORDER BY rowid', [codec])
+        blob_rowids = [row[0] for row in cur.fetchall()]
+
+        n_bytes = [0, 0]
+        # one log at a time to keep memory use bounded
+        for i, rowid in enumerate(log_rowids):
+            cur.execute('SELECT logfile, codec FROM log WHERE rowid=?',
+                        [rowid])
+            logfile, old_codec = cur.fetchone()
+            blob = decompress_log(logfile, old_codec)
+            hash = get_log_hash(blob)
+            cur.execute('SELECT count(*) FROM log_blob WHERE hash=?', [hash])
+            if cur.fetchone()[0] == 0:
+                blob = compress_log(blob, codec)[1]
+                cur.execute('INSERT INTO log_blob(hash, codec, logfile) '
+                            'VALUES (?, ?, ?)', [hash, codec, blob])
+                n_bytes[1] += len(blob or b'')
+            cur.execute('UPDATE log SET logfile=NULL, codec=NULL, hash=? '
+                        'WHERE rowid=?', [hash, rowid])
+            n_bytes[0] += len(logfile)
+            if (i + 1) % 100 == 0:
+                con.commit()
+
+        for i, rowid in enumerate(blob_rowids):
+            cur.execute('SELECT logfile, codec FROM log_blob WHERE rowid=?',
+                        [rowid])
+            logfile, old_codec = cur.fetchone()
+            blob = compress_log(decompress_log(logfile, old_codec),
+                                codec)[1]
+            cur.execute('UPDATE log_blob SET logfile=?, codec=? '
+                        'WHERE rowid=?', [blob, codec, rowid])
+            n_bytes[0] += len(logfile or b'')
+            n_bytes[1] += len(blob or b'')
+            if (i + 1) % 100 == 0:
+                con.commit()
+        con.commit()
+
+        n_logs = len(log_rowids) + len(blob_rowids)
+        if n_logs:
+            con.execute('VACUUM')
+        self.stdout.write(
+            'Stored {0} logs with codec {1}: {2:.1f} MB -> {3:.1f} MB\n'
+            .format(n_logs, codec, n_bytes[0] / 1e6, n_bytes[1] / 1e6))
+
+        if self.connection is None:
+            con.close()
+
+        return n_logs
+
     def write(self, values, data=None):
         """
         Write reaction info to db file
@@ -282,48 +550,21 @@ class CathubSQLite:
         self._initialize(con)
         cur = con.cursor()
 
-        pub_id = values['pub_id']
-        ase_ids = values['ase_ids']
-        energy_corrections = values['energy_corrections']
-
-        if ase_ids is not None:
-            check_ase_ids(values, ase_ids)
-        else:
-            ase_ids = {}
-        values = (values['chemical_composition'],
-                  values['surface_composition'],
-                  values['facet'],
-                  json.dumps(values['sites']),
-                  json.dumps(values['coverages']),
-                  json.dumps(values['reactants']),
-                  json.dumps(values['products']),
-                  values['reaction_energy'],
-                  values['activation_energy'],
-                  values['dft_code'],
-                  values['dft_functional'],
-                  values['username'],
-                  values['pub_id']
-                  )
+        reaction_values = get_reaction_values(values)
 
         """ Write to reaction table"""
-        q = self.default + ',' + ', '.join('?' * len(values))
+        q = self.default + ',' + ', '.join('?' * len(reaction_values))
         cur.execute('INSERT INTO reaction VALUES ({})'.format(q),
-                    values)
+                    reaction_values)
         id = self.get_last_id(cur)
 
-        reaction_structure_values = []
-
         """ Write to publication_system and reaction_system tables"""
-        for name, ase_id in ase_ids.items():
-            if name in energy_corrections:
-                energy_correction = energy_corrections[name]
-            else:
-                energy_correction = 0
-            reaction_structure_values.append([name, energy_correction,
-                                              ase_id, id])
-            insert_statement = """INSERT OR IGNORE INTO
-            publication_system(ase_id, pub_id) VALUES (?, ?)"""
-            cur.execute(insert_statement, [ase_id, pub_id])
+        reaction_structure_values, publication_structure_values = \
+            get_structure_values(values, id)
+
+        insert_statement = """INSERT OR IGNORE INTO
+        publication_system(ase_id, pub_id) VALUES (?, ?)"""
+        cur.executemany(insert_statement, publication_structure_values)
 
         cur.executemany('INSERT INTO reaction_system VALUES (?, ?, ?, ?)',
                         reaction_structure_values)
@@ -334,6 +575,75 @@ class CathubSQLite:
 
         return id
 
+    def write_many(self, values_iter, batch_size=1000):
+        """
+        Write several reactions to db file, using a single transaction
+        for each batch of reactions. Rows are inserted into the reaction,
+        reaction_system and publication_system tables with executemany.
+
+        The iterable is only consumed between transactions, so it may itself
+        write to the db file (as FolderReader.read does for structures).
+
+        Parameters
+        ----------
+        values_iter: iterable of dict
+            reaction info. See write() method for details
+        batch_size: int
+            number of reactions to write per transaction. default is 1000
+
+        Returns list of reaction ids, in the same order as values_iter
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+
+        ids = []
+        batch = []
+        for values in values_iter:
+            batch.append(values)
+            if len(batch) >= batch_size:
+                ids += self._write_batch(con, batch)
+                batch = []
+        if batch:
+            ids += self._write_batch(con, batch)
+
+        if self.connection is None:
+            con.close()
+
+        return ids
+
+    def _write_batch(self, con, batch):
+        """Write one batch of reactions in a single transaction"""
+        cur = con.cursor()
+        reaction_values = [get_reaction_values(values) for values in batch]
+
+        q = self.default + ',' + ', '.join('?' * len(reaction_values[0]))
+        try:
+            cur.executemany('INSERT INTO reaction VALUES ({})'.format(q),
+                            reaction_values)
+            # AUTOINCREMENT ids are assigned consecutively and the write
+            # lock is held until commit, so the batch ends at the last id
+            last_id = self.get_last_id(cur)
+            ids = list(range(last_id - len(batch) + 1, last_id + 1))
+
+            reaction_structure_values = []
+            publication_structure_values = []
+            for id, values in zip(ids, batch):
+                rs_values, ps_values = get_structure_values(values, id)
+                reaction_structure_values += rs_values
+                publication_structure_values += ps_values
+
+            cur.executemany("""INSERT OR IGNORE INTO
+            publication_system(ase_id, pub_id) VALUES (?, ?)""",
+                            publication_structure_values)
+            cur.executemany('INSERT INTO reaction_system VALUES (?, ?, ?, ?)',
+                            reaction_structure_values)
+        except BaseException:
+            con.rollback()
+            raise
+        con.commit()
+
+        return ids
+
     def update(self, id, values, key_names='all'):
         """
         Update reaction info for a selected row
@@ -373,6 +683,7 @@ class CathubSQLite:
             .format(execute_str, id)
 
         cur.execute(update_command)
+        self._update_fingerprint(cur, id)
 
         delete_command = 'DELETE from reaction_system WHERE id = {}'.format(id)
         cur.execute(delete_command)
@@ -394,6 +705,16 @@ class CathubSQLite:
             con.close()
         return id
 
+    def _update_fingerprint(self, cur, id):
+        cur.execute(
+            """SELECT chemical_composition, facet, sites, reactants,
+            products, reaction_energy FROM reaction WHERE id=?""", [id])
+        values = dict(zip(['chemical_composition', 'facet', 'sites',
+                           'reactants', 'products', 'reaction_energy'],
+                          cur.fetchone()))
+        cur.execute('UPDATE reaction SET fingerprint=? WHERE id=?',
+                    [get_reaction_fingerprint(values), id])
+
     def get_last_id(self, cur, table='reaction'):
         """
         Get the id of the last written row in table
@@ -459,12 +780,12 @@ class CathubSQLite:
         self._initialize(con)
         cur = con.cursor()
         statement = """SELECT reaction.id FROM reaction WHERE
-        reaction.chemical_composition='{}' and reaction.reactants='{}'
-        and reaction.products='{}';""".format(chemical_composition,
-                                              json.dumps(reactants),
-                                              json.dumps(products))
+        reaction.chemical_composition=? and reaction.reactants=?
+        and reaction.products=?"""
+        argument = [chemical_composition, json.dumps(reactants),
+                    json.dumps(products)]
 
-        cur.execute(statement)
+        cur.execute(statement, argument)
         rows = cur.fetchall()
         if len(rows) > 0:
             id = rows[0][0]
@@ -472,6 +793,56 @@ class CathubSQLite:
             id = None
         return id
 
+    def get_reaction_keys(self):
+        """
+        Get keys for duplicate checks of all reactions in the database file,
+        in a single query. See get_reaction_key()
+
+        Returns dict mapping keys to reaction ids
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+        cur.execute("""SELECT id, chemical_composition, reaction_energy,
+        reactants, products FROM reaction""")
+
+        reaction_keys = {}
+        for id, chemical_composition, reaction_energy, reactants, products \
+                in cur.fetchall():
+            key = get_reaction_key({'chemical_composition':
+                                    chemical_composition,
+                                    'reaction_energy': reaction_energy,
+                                    'reactants': reactants,
+                                    'products': products})
+            reaction_keys.setdefault(key, id)
+
+        if self.connection is None:
+            con.close()
+
+        return reaction_keys
+
+    def get_check_keys(self):
+        """
+        Get the (chemical_composition, reaction_energy) keys used by
+        check() for all reactions in the database file, in a single query.
+
+        Returns dict mapping keys to reaction ids
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+        cur.execute("""SELECT id, chemical_composition, reaction_energy
+        FROM reaction""")
+
+        check_keys = {}
+        for id, chemical_composition, reaction_energy in cur.fetchall():
+            check_keys.setdefault((chemical_composition, reaction_energy), id)
+
+        if self.connection is None:
+            con.close()
+
+        return check_keys
+
     def check_publication(self, pub_id):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -544,32 +915,40 @@ class CathubSQLite:
 
     def write_structure(self, atoms, data=None, update=False,
                         **key_value_pairs):
-        """Connect to ASE db"""
+        """Write structure to ASE db, together with its output files.
 
-        db_ase = ase.db.connect(self.filename)
-        db_ase.connection = self.connection
-
-        if db_ase.connection:
-            db_ase.change_count = 0
+        Structures already in the db are found by the
+        structure_fingerprint key, see get_structure_fingerprint.
+        """
+        con = self.connection or self._connect()
+        self._initialize(con)
+        db_ase = self._get_ase_db()
         _normalize_key_value_pairs_inplace(key_value_pairs)
 
-        energy = atoms.get_potential_energy()
         formula = atoms.get_chemical_formula()
         filename = atoms.info.get('filename')
         base_dir = os.path.dirname(filename)
 
-        rows = db_ase.select(energy=energy)
+        fingerprint = get_structure_fingerprint(atoms)
+        key_value_pairs['structure_fingerprint'] = fingerprint
+
+        cur = con.execute("""SELECT id FROM text_key_values
+        WHERE key='structure_fingerprint' AND value=?""", [fingerprint])
+        row = cur.fetchone()
+        if row is not None:
+            row = db_ase.get(row[0])
+        if self.connection is None:
+            con.close()
+
         id = None
         former_keys = {}
-        for row in rows:
-            if np.all(row.forces == atoms.get_forces()):
-                if update:
-                    count = db_ase.update(row.id, **key_value_pairs)
-                    self.stdout.write('  Updating {0} key value pairs in ASE db row id = {1}\n'
-                                    .format(count, row.id))
-                id = row.id
-                former_keys = row.key_value_pairs
-                break
+        if row is not None:
+            if update:
+                count = db_ase.update(row.id, **key_value_pairs)
+                self.stdout.write('  Updating {0} key value pairs in ASE db row id = {1}\n'
+                                .format(count, row.id))
+            id = row.id
+            former_keys = row.key_value_pairs
         if not id:
             id = db_ase.write(atoms, data=data, **key_value_pairs)
 
@@ -587,9 +966,7 @@ class CathubSQLite:
                 print(out_name, ' already written.')
                 continue
             if os.path.isfile(output_file):
-                with open(output_file, 'rb') as file:
-                    blobData = file.read()
-                self.write_log(ase_id, out, blobData)
+                self.write_log_file(ase_id, out, output_file)
                 print('Wrote: ', out)
                 written_outputs[out_name] = 1
             else:
@@ -600,12 +977,117 @@ class CathubSQLite:
         return ase_id
 
 
+def get_structure_fingerprint(atoms, decimals=4):
+    """Hash of atomic numbers, positions, cell and energy, with
+    positions and cell rounded to decimals and energy to 6 decimals"""
+    energy = round(float(atoms.get_potential_energy()), 6)
+    # adding 0.0 turns -0.0 into 0.0
+    values = [atoms.get_atomic_numbers().tolist(),
+              (np.round(atoms.get_positions(), decimals) + 0.0).tolist(),
+              (np.round(np.array(atoms.get_cell()), decimals) + 0.0).tolist(),
+              energy + 0.0]
+    values = json.dumps(values)
+    return hashlib.blake2b(values.encode(), digest_size=16).hexdigest()
+
+
 def _normalize_key_value_pairs_inplace(data):
     for key in data:
         if isinstance(data[key], np.int64):
             data[key] = int(data[key])
 
 
+def get_reaction_values(values):
+    """Row for the reaction table (without id) from reaction info dict"""
+    return (values['chemical_composition'],
+            values['surface_composition'],
+            values['facet'],
+            json.dumps(values['sites']),
+            json.dumps(values['coverages']),
+            json.dumps(values['reactants']),
+            json.dumps(values['products']),
+            values['reaction_energy'],
+            values['activation_energy'],
+            values['dft_code'],
+            values['dft_functional'],
+            values['username'],
+            values['pub_id'],
+            get_reaction_fingerprint(values)
+            )
+
+
+def get_reaction_fingerprint(values):
+    """Canonical string identifying a reaction entry, built from the
+    chemical composition, facet, sites, sorted reactants and products and
+    the reaction energy rounded to 4 decimals.
+
+    Parameters
+    ----------
+    values: dict
+        reaction info. sites, reactants and products can be given as
+        dicts or json strings
+    """
+    sites = values.get('sites')
+    if isinstance(sites, str):
+        sites = json.loads(sites)
+
+    reaction_energy = values.get('reaction_energy')
+    if reaction_energy is not None:
+        reaction_energy = round(float(reaction_energy), 4)
+
+    fingerprint = [values.get('chemical_composition'),
+                   values.get('facet'),
+                   sites or {},
+                   get_species(values.get('reactants')),
+                   get_species(values.get('products')),
+                   reaction_energy]
+
+    return json.dumps(fingerprint, sort_keys=True)
+
+
+def get_reaction_key(values):
+    """Key used for duplicate checks of reactions: chemical composition,
+    reaction energy and the canonical equation (sorted reactants and
+    products)"""
+    equation = json.dumps([get_species(values.get('reactants')),
+                           get_species(values.get('products'))],
+                          sort_keys=True)
+    return (values['chemical_composition'], values['reaction_energy'],
+            equation)
+
+
+def get_species(species):
+    """Reactants or products as dict with float prefactors"""
+    if isinstance(species, str):
+        species = json.loads(species)
+    return {k: float(v) for k, v in (species or {}).items()}
+
+
+def get_structure_values(values, id):
+    """Rows for the reaction_system and publication_system tables
+    from reaction info dict"""
+    pub_id = values['pub_id']
+    ase_ids = values['ase_ids']
+    energy_corrections = values['energy_corrections'] or {}
+
+    if ase_ids is not None:
+        check_ase_ids(values, ase_ids)
+    else:
+        ase_ids = {}
+
+    reaction_structure_values = []
+    publication_structure_values = []
+    for name, ase_id in ase_ids.items():
+        if name in energy_corrections:
+            energy_correction = energy_corrections[name]
+        else:
+            energy_correction = 0
+        reaction_structure_values.append([name, energy_correction,
+                                          ase_id, id])
+        publication_structure_values.append([ase_id, pub_id])
+
+    return reaction_structure_values, publication_structure_values
+
+
 def check_ase_ids(values, ase_ids):
     ase_values = ase_ids.values()
     assert len(set(ase_values)) == len(ase_values), 'Duplicate ASE ids!'
@@ -690,3 +1172,45 @@ def get_equation(reactants, products):
             equation += str(prefactor) + key
             i += 1
     return equation
+
+
+def default_codec():
+    """zstd if the zstandard package is available, otherwise zlib"""
+    if zstandard is not None:
+        return 'zstd'
+    return 'zlib'
+
+
+def get_log_hash(blob):
+    """ BLAKE2 hash of log file content"""
+    return hashlib.blake2b(blob, digest_size=32).hexdigest()
+
+
+def compress_log(blob, codec='default'):
+    """ Compress log file content
+
+    Returns (codec, compressed blob)
+    """
+    if codec == 'default':
+        codec = default_codec()
+    if blob is None or codec is None:
+        return None, blob
+    if codec == 'zstd':
+        return codec, zstandard.ZstdCompressor().compress(blob)
+    elif codec == 'zlib':
+        return codec, zlib.compress(blob)
+    raise ValueError('Unknown log codec: {}'.format(codec))
+
+
+def decompress_log(blob, codec):
+    """ Return log file content stored with codec"""
+    if blob is None or codec is None:
+        return blob
+    blob = bytes(blob)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is required to read this log')
+        return zstandard.ZstdDecompressor().decompress(blob)
+    elif codec == 'zlib':
+        return zlib.decompress(blob)
+    raise ValueError('Unknown log codec: {}'.format(codec))
@@ -98,17 +98,34 @@ def exp(pubid, dbuser, dbpassword, args):
     help="""Bounds for accepted absolute reaction energies in eV""")
 @click.option('--goto-reaction',
               help="""name of reaction folder to skip ahead to""")
+@click.option('-j', '--workers',
+              default=1,
+              type=int,
+              show_default=True,
+              help="""Number of processes used to parse structure files""")
+@click.option('--cache/--no-cache', 'use_cache',
+              default=False,
+              show_default=True,
+              help="""Keep parsed structures in a .cathub_cache.db file
+              in the folder""")
+@click.option('--clear-cache',
+              is_flag=True,
+              default=False,
+              help="""Invalidate the parse cache and read all files again.
+              Implies --cache""")
 def folder2db(folder_name, debug, energy_limit, skip_folders,
-              goto_reaction):
+              goto_reaction, workers, use_cache, clear_cache):
     """Read folder and collect data in local sqlite3 database"""
 
+    use_cache = use_cache or clear_cache
     folder_name = folder_name.rstrip('/')
     skip = []
     for s in skip_folders.split(', '):
         for sk in s.split(','):
             skip.append(sk)
     pub_id = _folder2db.main(folder_name, debug, energy_limit,
-                             skip, goto_reaction)
+                             skip, goto_reaction, workers, use_cache,
+                             clear_cache)
     if pub_id:
         print('')
         print('')
@@ -125,7 +142,17 @@ def folder2db(folder_name, debug, energy_limit, skip_folders,
               show_default=True)
 @click.option('--dbuser', default='upload', type=str)
 @click.option('--dbpassword', default='cHyuuQH0', type=str)
-def db2server(dbfile, block_size, dbuser, dbpassword):
+@click.option('--resume', is_flag=True, default=False,
+              help="""Continue an interrupted transfer from the last
+              completed block""")
+@click.option('-j', '--workers', default=1, type=int, show_default=True,
+              help="""Number of connections used in parallel to upload
+              atomic structures and logs""")
+@click.option('--log-block-size', default=100, type=int, show_default=True,
+              help="""Maximum size in MB of the output files uploaded
+              together in each block of logs""")
+def db2server(dbfile, block_size, dbuser, dbpassword, resume, workers,
+              log_block_size):
     """Transfer data from local database to Catalysis Hub server"""
 
     _db2server.main(dbfile,
@@ -135,6 +162,9 @@ def db2server(dbfile, block_size, dbuser, dbpassword):
                     write_reaction_system=True,
                     block_size=block_size,
                     start_block=0,
+                    resume=resume,
+                    workers=workers,
+                    log_block_bytes=log_block_size * 1024**2,
                     user=dbuser,
                     password=dbpassword)
 
@@ -176,6 +206,10 @@ publication_columns = [
 @click.option('--n-results', '-n', default=10, show_default=True)
 @click.option('--write-db', '-w', is_flag=True, default=False,
               show_default=True)
+@click.option('--page-size', '-p', default=100, show_default=True,
+              help='Number of reactions fetched from the server per request')
+@click.option('--no-cache', is_flag=True, default=False,
+              help='Do not use the local cache of server responses')
 @click.option(
     '--queries',
     '-q',
@@ -187,8 +221,9 @@ publication_columns = [
     \n -q reactants=CO for reactions with CO as a reactants"""
     .format(reaction_columns))
 # Keep {0} in string.format for python2.6 compatibility
-def reactions(columns, n_results, write_db, queries):
+def reactions(columns, n_results, write_db, page_size, no_cache, queries):
     """Search for reactions"""
+    query.set_cache(not no_cache)
     if not isinstance(queries, dict):
         query_dict = {}
         for q in queries:
@@ -209,6 +244,7 @@ def reactions(columns, n_results, write_db, queries):
     data = query.get_reactions(columns=columns,
                                n_results=n_results,
                                write_db=write_db,
+                               page_size=page_size,
                                **query_dict)
 
     if write_db:
@@ -230,6 +266,8 @@ def reactions(columns, n_results, write_db, queries):
               show_default=True,
               multiple=True)
 @click.option('--n-results', '-n', default=10)
+@click.option('--no-cache', is_flag=True, default=False,
+              help='Do not use the local cache of server responses')
 @click.option(
     '--queries',
     '-q',
@@ -239,8 +277,9 @@ def reactions(columns, n_results, write_db, queries):
     help="""Make a selection on one of the columns:
     {0}\n Examples: \n -q: \n title=~Evolution \n authors=~bajdich
     \n year=2017""".format(publication_columns))
-def publications(columns, n_results, queries):
+def publications(columns, n_results, no_cache, queries):
     """Search for publications"""
+    query.set_cache(not no_cache)
     if not isinstance(queries, dict):
         query_dict = {}
         for q in queries:
@@ -576,10 +615,29 @@ def connect(user):
     show_default=True,
     help="Extensions considered for main structure file read by ASE")
 
+@click.option(
+    '-j', '--workers',
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of processes used to parse structure files")
+@click.option(
+    '--cache/--no-cache', 'use_cache',
+    default=False,
+    show_default=True,
+    help="Keep parsed structures in a .cathub_cache.db file in the folder")
+@click.option(
+    '--clear-cache',
+    is_flag=True,
+    default=False,
+    help="Invalidate the parse cache and read all files again. "
+    "Implies --cache")
+
 
 def organize(**kwargs):
     """Read reactions from non-organized folder"""
 
+    kwargs['use_cache'] = kwargs['use_cache'] or kwargs['clear_cache']
     kwargs['adsorbates'] = kwargs['adsorbates'].split(',')
 
     if kwargs['energy_corrections']:
@@ -613,17 +671,40 @@ def organize(**kwargs):
     show_default=True,
     help="Name of output db")
 
+@click.option(
+    '-j', '--workers',
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of processes used to parse structure files")
+@click.option(
+    '--cache/--no-cache', 'use_cache',
+    default=False,
+    show_default=True,
+    help="Keep parsed structures in a .cathub_cache.db file in the folder")
+@click.option(
+    '--clear-cache',
+    is_flag=True,
+    default=False,
+    help="Invalidate the parse cache and read all files again. "
+    "Implies --cache")
+
 
 def collect(folder_name, **kwargs):
     file_extensions = kwargs['file_extensions'].split(',')
+    use_cache = kwargs['use_cache'] or kwargs['clear_cache']
 
     dbname = kwargs['out_db'] or \
         folder_name.replace('.', '').replace('/', '_').rstrip('_') + '_cathub.db'
     with CathubSQLite(dbname) as db:
         for s in ase_tools.collect_structures(folder_name,
                                               file_extensions=file_extensions,
-                                              verbose=True):
-            db.write_structure(s[-1])
+                                              verbose=True,
+                                              workers=kwargs['workers'],
+                                              cache=folder_name
+                                              if use_cache else None,
+                                              clear_cache=kwargs['clear_cache']):
+            db.write_structure(s)
 
 @cli.command()
 @click.argument('dbfile')
@@ -669,3 +750,18 @@ def get_log(dbfile, id, out_file):
                     logtype = 'vasprun.xml'
                 with open(path + logtype, 'wb') as file:
                     file.write(logfile)
+
+
+@cli.command()
+@click.argument('dbfile')
+@click.option('--codec', default='default', show_default=True,
+              type=click.Choice(['default', 'zstd', 'zlib', 'none']),
+              help="""Compression of stored log files. The default is zstd
+              if the zstandard package is installed, otherwise zlib.
+              Use 'none' to store logs uncompressed""")
+def compress_logs(dbfile, codec):
+    """Compress log files stored in db with an earlier version of cathub"""
+    if codec == 'none':
+        codec = None
+    db = CathubSQLite(dbfile)
+    db.compress_logs(codec=codec)
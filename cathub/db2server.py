@@ -5,6 +5,9 @@ from sys import argv, stdout
 def main(dbfile, write_reaction=True, write_ase=True,
          write_publication=True, write_reaction_system=True,
          block_size=1000, start_block=0,
+         resume=False,
+         workers=1,
+         log_block_bytes=100 * 1024**2,
          user='catroot',
          password=None,
          ):
@@ -18,7 +21,10 @@ def main(dbfile, write_reaction=True, write_ase=True,
                 write_publication=write_publication,
                 write_reaction_system=write_reaction_system,
                 block_size=block_size,
-                start_block=start_block)
+                start_block=start_block,
+                resume=resume,
+                workers=workers,
+                log_block_bytes=log_block_bytes)
 
 
 if __name__ == '__main__':
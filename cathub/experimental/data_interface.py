@@ -1,7 +1,6 @@
 import warnings
 from cathub.tools import get_pub_id, doi_request
 from cathub.postgresql import CathubPostgreSQL, get_value_str, get_key_list, get_key_str
-from sqlalchemy import create_engine
 import pylab as p
 import numpy as np
 from pandas import read_sql
@@ -4,10 +4,13 @@ from .folderreader import FolderReader
 
 
 def main(folder_name, debug=False, energy_limit=5, skip=[],
-         goto_reaction=None):
+         goto_reaction=None, workers=1, use_cache=False,
+         clear_cache=False):
     folder_name = folder_name.rstrip('/')
     FR = FolderReader(folder_name=folder_name, debug=debug,
-                      energy_limit=energy_limit)
+                      energy_limit=energy_limit, workers=workers,
+                      cache=folder_name if use_cache else None,
+                      clear_cache=clear_cache)
     FR.write(skip=skip, goto_reaction=goto_reaction)
     return FR.pub_id
 
@@ -1,10 +1,12 @@
-from .cathubsqlite import CathubSQLite
+from .cathubsqlite import CathubSQLite, get_reaction_key
 from .tools import get_bases, clear_prefactor, clear_state, get_pub_id,\
     extract_atoms
 from .ase_tools import collect_structures
+from .ase_tools.parse_cache import ParseCache
 from . import ase_tools
 
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 import numpy as np
 import os
@@ -40,16 +42,27 @@ class FolderReader:
         Update data if allready present in database file. defalt is True
     energy_limit: float
         Limit for acceptable absolute reaction energies
+    workers: int
+        Number of processes used to parse structure files
+    cache: str
+        Parse cache file or folder, see ase_tools.collect_structures
+    clear_cache: bool
+        Invalidate the parse cache before reading
     """
 
     def __init__(self, folder_name, debug=False, strict=True, verbose=False,
-                 update=False, energy_limit=5, stdin=sys.stdin,
-                 stdout=sys.stdout):
+                 update=False, energy_limit=5, workers=1, cache=None,
+                 clear_cache=False, stdin=sys.stdin, stdout=sys.stdout):
         self.debug = debug
         self.strict = strict
         self.verbose = verbose
         self.update = update
         self.energy_limit = energy_limit
+        self.workers = workers
+        self.executor = None
+        self.cache = cache
+        if cache is not None and clear_cache:
+            ParseCache(cache).clear()
 
         self.data_base, self.user, self.user_base \
             = get_bases(folder_name=folder_name)
@@ -102,84 +115,145 @@ class FolderReader:
         self.stdout.write('Starting folderreader \n')
         self.stdout.write('---------------------- \n\n')
         found_reaction = False
-        for root, dirs, files in os.walk(self.user_base):
-            for omit_folder in self.omit_folders:  # user specified omit_folder
-                if omit_folder in dirs:
-                    dirs.remove(omit_folder)
-            level = len(root.split("/")) - self.user_base_level
-
-            if level == self.pub_level:
-                self.read_pub(root)
-
-            if level == self.DFT_level:
-                self.DFT_code = os.path.basename(root)
-
-            if level == self.XC_level:
-                self.DFT_functional = os.path.basename(root)
-                self.gas_folder = root + '/gas/'
-                self.read_gas()
-
-            if level == self.reference_level:
-                if 'gas' in os.path.basename(root):
-                    continue
-
-                if goto_metal is not None:
-                    if os.path.basename(root) == goto_metal:
-                        goto_metal = None
-                    else:
-                        dirs[:] = []  # don't read any sub_dirs
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            for root, dirs, files in os.walk(self.user_base):
+                # user specified omit_folder
+                for omit_folder in self.omit_folders:
+                    if omit_folder in dirs:
+                        dirs.remove(omit_folder)
+                level = len(root.split("/")) - self.user_base_level
+
+                if level == self.pub_level:
+                    self.read_pub(root)
+
+                if level == self.DFT_level:
+                    self.DFT_code = os.path.basename(root)
+
+                if level == self.XC_level:
+                    self.DFT_functional = os.path.basename(root)
+                    self.gas_folder = root + '/gas/'
+                    self.read_gas()
+
+                if level == self.reference_level:
+                    if 'gas' in os.path.basename(root):
                         continue
-                self.read_bulk(root)
 
-            if level == self.slab_level:
-                self.read_slab(root)
-
-            if level == self.reaction_level:
-                if goto_reaction is not None:
-                    if os.path.basename(root) == goto_reaction:
-                        goto_reaction = None
-                    else:
-                        dirs[:] = []  # don't read any sub_dirs
-                        continue
+                    if goto_metal is not None:
+                        if os.path.basename(root) == goto_metal:
+                            goto_metal = None
+                        else:
+                            dirs[:] = []  # don't read any sub_dirs
+                            continue
+                    self.read_bulk(root)
 
-                self.read_reaction(root)
+                if level == self.slab_level:
+                    self.read_slab(root)
 
-            if level == self.final_level:
-                self.root = root
-                self.read_energies(root)
-                if self.key_value_pairs_reaction is not None:
-                    yield self.key_value_pairs_reaction
+                if level == self.reaction_level:
+                    if goto_reaction is not None:
+                        if os.path.basename(root) == goto_reaction:
+                            goto_reaction = None
+                        else:
+                            dirs[:] = []  # don't read any sub_dirs
+                            continue
+
+                    self.read_reaction(root)
+
+                if level == self.final_level:
+                    self.root = root
+                    self.read_energies(root)
+                    if self.key_value_pairs_reaction is not None:
+                        yield self.key_value_pairs_reaction
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def write(self, skip=[], goto_reaction=None, batch_size=1000):
+        """
+        Read reactions from folders and write them to the database file.
+        New reactions are collected and written in batches of batch_size
+        reactions, with a single transaction per batch.
 
-    def write(self, skip=[], goto_reaction=None):
+        Duplicate checks are answered from the keys of reactions already in
+        the database file, loaded once when the file is first used.
+        """
+        self.batch = []
+        self.batch_roots = []
+        self.batch_keys = {}
+        self.batch_db = None
         for key_values in self.read(skip=skip, goto_reaction=goto_reaction):
-            with CathubSQLite(self.cathub_db) as db:
-                id = db.check(
-                    key_values['chemical_composition'],
-                    key_values['reaction_energy'])
-                E_r = round(key_values['reaction_energy'], 3)
-                if id is None:
-                    try:
-                        id = db.write(key_values)
-
-                        self.stdout.write(
-                            '    Written to database with E_r = {}\n'.format(E_r))  # row id = {}\n'.format(id))
-                    except BaseException as e:
-                        self.raise_error(
-                            '    Writing error: {}. {}'.format(e, self.root))
-
-                elif self.update:
-                    db.update(id, key_values)
-                    self.stdout.write(
-                        '    Updated Reaction\n')  # row id = {}\n'.format(id))
+            if self.batch_db != self.cathub_db:
+                self.write_batch()
+                self.batch_db = self.cathub_db
+                db = CathubSQLite(self.cathub_db)
+                self.reaction_keys = db.get_reaction_keys()
+            key = get_reaction_key(key_values)
+            E_r = round(key_values['reaction_energy'], 3)
+            if key in self.batch_keys:
+                if self.update:
+                    self.batch[self.batch_keys[key]] = key_values
+                    self.batch_roots[self.batch_keys[key]] = self.root
+                    self.stdout.write('    Updated Reaction\n')
                 else:
                     self.stdout.write(
-                        '    Already in database with E_r = {}\n'.format(E_r))  # with row id = {}\n'.format(id))
+                        '    Already in database with E_r = {}\n'.format(E_r))
+                continue
+
+            id = self.reaction_keys.get(key)
+            if id is None:
+                self.batch_keys[key] = len(self.batch)
+                self.batch.append(key_values)
+                self.batch_roots.append(self.root)
+                self.stdout.write(
+                    '    New reaction with E_r = {}\n'.format(E_r))
+                if len(self.batch) >= batch_size:
+                    self.write_batch()
+            elif self.update:
+                db.update(id, key_values)
+                self.stdout.write(
+                    '    Updated Reaction\n')  # row id = {}\n'.format(id))
+            else:
+                self.stdout.write(
+                    '    Already in database with E_r = {}\n'.format(E_r))  # with row id = {}\n'.format(id))
+        self.write_batch()
         assert self.cathub_db is not None, \
             'Wrong folder! No reactions found in {base}'\
             .format(base=self.user_base)
         self.print_warnings()
         self.get_summary()
 
+    def write_batch(self):
+        """Write collected reactions to the database file. If the batch
+        can not be written, its reactions are written one at a time, so
+        that only the failing reactions are left out"""
+        if not self.batch:
+            return []
+        db = CathubSQLite(self.batch_db)
+        try:
+            ids = db.write_many(self.batch, batch_size=len(self.batch))
+        except Exception:
+            ids = []
+            for key_values, root in zip(self.batch, self.batch_roots):
+                try:
+                    ids += db.write_many([key_values])
+                except Exception as e:
+                    ids += [None]
+                    self.raise_error(
+                        '    Writing error: {}. {}'.format(e, root))
+        for key, i in self.batch_keys.items():
+            if ids[i] is not None:
+                self.reaction_keys[key] = ids[i]
+        n_written = len([id for id in ids if id is not None])
+        self.stdout.write('    Written {} reactions to {}\n'.format(
+            n_written, self.batch_db))
+        self.batch = []
+        self.batch_roots = []
+        self.batch_keys = {}
+        return ids
+
     def get_summary(self):
         with CathubSQLite(self.cathub_db) as db:
             db.print_summary()
@@ -289,7 +363,10 @@ class FolderReader:
         pid = self.write_publication(pub_data)
 
     def read_gas(self):
-        gas_structures = list(collect_structures(self.gas_folder, level='*'))
+        gas_structures = list(collect_structures(self.gas_folder, level='*',
+                                                 workers=self.workers,
+                                                 cache=self.cache,
+                                                 executor=self.executor))
         self.ase_ids_gas = {}
         self.gas = {}
 
@@ -324,7 +401,10 @@ class FolderReader:
 
         self.ase_ids = {}
 
-        bulk_structures = list(collect_structures(root, level='*'))
+        bulk_structures = list(collect_structures(root, level='*',
+                                                  workers=self.workers,
+                                                  cache=self.cache,
+                                                  executor=self.executor))
         n_bulk = len(bulk_structures)
         if n_bulk == 0:
             return
@@ -358,7 +438,10 @@ class FolderReader:
 
         self.ase_facet = 'x'.join(list(self.facet))
 
-        empty_structures = list(collect_structures(root, level='*'))
+        empty_structures = list(collect_structures(root, level='*',
+                                                   workers=self.workers,
+                                                   cache=self.cache,
+                                                   executor=self.executor))
         n_empty = len(empty_structures)
 
         if n_empty == 0:
@@ -434,7 +517,10 @@ class FolderReader:
     def read_energies(self, root):
         self.key_value_pairs_reaction = None
         self.coverages = {}
-        slab_structures = list(collect_structures(root))
+        slab_structures = list(collect_structures(root,
+                                                  workers=self.workers,
+                                                  cache=self.cache,
+                                                  executor=self.executor))
         filenames = [slab.info['filename'] for slab in slab_structures]
         slab_structures = [slab_structures[i] for i in np.argsort(filenames)]
 
@@ -754,7 +840,7 @@ class FolderReader:
             'pub_id': self.pub_id,
             'doi': self.doi,
             'year': int(self.year),
-            'ase_ids': self.ase_ids,
+            'ase_ids': self.ase_ids.copy(),
             'energy_corrections': self.energy_corrections,
             'username': self.user}
 
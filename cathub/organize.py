@@ -2,8 +2,8 @@
 
 import os
 from .ase_tools import gas_phase_references, get_chemical_formula, \
-    get_reduced_chemical_formula, symbols, collect_structures, \
-    compare_parameters, copy_atoms
+    get_reduced_chemical_formula, collect_structures, \
+    compare_parameters, get_parameter_key, copy_atoms
 import cathub.ase_tools
 import ase.atoms
 import ase.utils
@@ -26,15 +26,21 @@ def fuzzy_match(structures, options):
     # filter out cell with ill-defined unit cells
     structures = [s for s in structures
                   if s.number_of_lattice_vectors == 3]
+    # volumes and densities are computed once and kept in the same
+    # order as structures
+    volumes = np.array([s.get_volume() for s in structures])
+    densities = np.array([len(s) for s in structures]) / volumes
     # sort by density
-    structures = sorted(structures,
-                        key=lambda x: len(x) / x.get_volume()
-                        )
+    order = np.argsort(densities, kind='stable')
+    structures = [structures[n] for n in order]
+    volumes = volumes[order]
+    densities = densities[order]
     adsorbate_numbers = [sorted(ase.atoms.Atoms(ads).numbers)
                          for ads in options.adsorbates]  # .split(',')]
 
     # group in to bulk, surface, or bulk
     molecules, surfaces, bulks = [], [], []
+    surface_volumes = []
     gas_phase_candidates = []
     reference_energy = {}
     collected_energies = {}
@@ -45,7 +51,7 @@ def fuzzy_match(structures, options):
     if options.verbose:
         print("\nGroup By Densities")
         print("===================")
-    for structure in structures:
+    for structure, volume, density in zip(structures, volumes, densities):
         # add more info from filename
         facet_match = re.search(
             '(?<=[^0-9])?[0-9]{3,3}(?=[^0-9])?', '/'.join(structure.info['filename'].split('/')[::-1]))
@@ -59,7 +65,6 @@ def fuzzy_match(structures, options):
         if site_match:
             structure.info['site'] = site_match[0]
 
-        density = len(structure) / structure.get_volume()
         if options.verbose:
             print("  {density:7.3f} {filename}".format(
                 density=density,
@@ -90,6 +95,7 @@ def fuzzy_match(structures, options):
             structure.info['state'] = 'surface'
             formula = get_chemical_formula(structure)
             surfaces.append(structure)
+            surface_volumes.append(volume)
             if options.verbose:
                 print("        SURFACE", formula,
                       structure.info['filename'])
@@ -100,11 +106,6 @@ def fuzzy_match(structures, options):
             if options.verbose:
                 print("        BULK", formula, structure.info['filename'])
 
-    # sort surfaces by volume to get difference facets
-    surfaces = sorted(surfaces,
-                      key=lambda x: x.get_volume()
-                      )
-
     # Get minimal set of gas phase candidates
     gas_phase_candidates = list(
         sorted(
@@ -121,20 +122,15 @@ def fuzzy_match(structures, options):
             "\nInclude additional folders with 'cathub organize -d foldername/'\n")
 
     volume_groups = {}
+    reference_systems = {}
     tolerance = 1e-5
     if options.verbose:
         print("\nGroup by volume")
         print("==================")
-    for surface in sorted(surfaces,
-                          key=lambda x: x.get_volume(),):
-        formula = symbols(surface)
-
-        for volume in volume_groups:
-            if abs(volume - surface.get_volume()) < tolerance:
-                volume_groups[volume].append(surface)
-                break
-        else:
-            volume_groups[surface.get_volume()] = [surface]
+    # Group surfaces by volume to get different facets
+    for volume, indices in group_by_volume(surface_volumes,
+                                           tolerance).items():
+        volume_groups[volume] = [surfaces[n] for n in indices]
 
     for volume in volume_groups:
         if options.verbose:
@@ -165,6 +161,22 @@ def fuzzy_match(structures, options):
             sorted_surfaces += subset
 
         surfaces = sorted_surfaces
+        # Pre-pass: composition, parameters and constraints of each
+        # surface, so incompatible pairs are rejected by cheap
+        # comparisons before any geometry work
+        max_number = max([s.numbers.max() for s in surfaces])
+        counts = np.array([np.bincount(s.numbers, minlength=max_number + 1)
+                           for s in surfaces])
+        energies = [s.get_potential_energy() for s in surfaces]
+        parameter_keys = [get_parameter_key(s) for s in surfaces]
+        fixed_positions = [get_fixed_positions(s) for s in surfaces]
+        fixed_keys = [get_position_keys(p) if p is not None else None
+                      for p in fixed_positions]
+        position_keys = {}
+        if options.verbose:
+            metal_formulas = [get_chemical_formula(s, mode='metal')
+                              for s in surfaces]
+
         if options.keep_all_slabs:
             n_empty = len(surfaces)
         else:
@@ -172,20 +184,65 @@ def fuzzy_match(structures, options):
         for i, surf_empty in enumerate(surfaces[:n_empty]):
             surf_empty = copy_atoms(surf_empty)
             surf_empty.set_tags(None)
-            for j, surf_ads in enumerate(surfaces[i+1:]):
-                surf_ads = copy_atoms(surf_ads)
-
-                if surf_empty.get_chemical_formula() == surf_ads.get_chemical_formula():
+            # i is reused by the loop over references below
+            i_empty = i
+            equal_numbers = sorted(surf_empty.numbers)
+            equal_formula = get_reduced_chemical_formula(
+                ase.atoms.Atoms(equal_numbers))
+            candidates = list(range(i + 1, len(surfaces)))
+            same_formula = np.all(counts[i + 1:] == counts[i], axis=1)
+            contains_empty = np.all(counts[i + 1:] >= counts[i], axis=1)
+
+            param_checks = []
+            constraint_flags = []
+            batch = []
+            for k, j in enumerate(candidates):
+                if not check_parameters or None in [parameter_keys[i],
+                                                    parameter_keys[j]]:
+                    param_checks.append(2)
+                elif parameter_keys[i] == parameter_keys[j]:
+                    param_checks.append(1)
+                else:
+                    # Decided by compare_parameters in the loop below
+                    param_checks.append(None)
+                c_flag = 0
+                if not options.skip_constraints and \
+                        fixed_positions[i] is not None:
+                    for n in [i, j]:
+                        if n not in position_keys:
+                            position_keys[n] = set(
+                                get_position_keys(surfaces[n].positions))
+                    c_flag = fixed_positions[j] is None or not (
+                        positions_match(fixed_positions[i], fixed_keys[i],
+                                        surfaces[j], position_keys[j]) and
+                        positions_match(fixed_positions[j], fixed_keys[j],
+                                        surfaces[i], position_keys[i]))
+                constraint_flags.append(c_flag)
+                if not same_formula[k] and contains_empty[k] and \
+                        param_checks[-1] is not None and not c_flag:
+                    batch.append(j)
+
+            displaced_atoms = get_displaced_atoms(
+                [surfaces[j] for j in batch], surf_empty,
+                options.reorganization_tol)
+            displaced_atoms = dict(zip(batch, displaced_atoms))
+
+            for k, j in enumerate(candidates):
+                surf_ads = surfaces[j]
+
+                if same_formula[k]:
                     continue
                 if options.verbose:
-                    print('\n    {} vs {}'.format(get_chemical_formula(surf_empty, mode='metal'),
-                                                  get_chemical_formula(surf_ads, mode='metal')))
+                    print('\n    {} vs {}'.format(metal_formulas[i_empty],
+                                                  metal_formulas[j]))
                     print('    -------------------')
 
                 # Check for calculator parameter consistency
                 if check_parameters:
-                    param_check = compare_parameters(surf_empty,
-                                                     surf_ads)
+                    param_check = param_checks[k]
+                    if param_check is None:
+                        param_check = compare_parameters(surf_empty,
+                                                         surf_ads)
                     if param_check == 2 and options.verbose:
                         print("        -Warning: Insufficient calculator information for"
                               " {} + {}".format(surf_empty.info['filename'],
@@ -199,65 +256,24 @@ def fuzzy_match(structures, options):
                                                      surf_ads.info['filename']))
                         continue
 
-                if not options.skip_constraints:
-                    constraints_empty = [c.todict()['kwargs']['indices']
-                                         for c in surf_empty.constraints
-                                         if c.todict()['name'] == 'FixAtoms']
-                    constraints_ads = [c.todict()['kwargs']['indices']
-                                       for c in surf_ads.constraints
-                                       if c.todict()['name'] == 'FixAtoms']
-
-                    c_flag = 0
-                    if len(constraints_empty) > 0:
-                        c_indices = constraints_empty[0]
-                        constrained_positions = surf_empty[c_indices].positions
-                        ads_positions = surf_ads.positions
-                        for cp in constrained_positions:
-                            if not np.any(np.all(np.isclose(cp, ads_positions,
-                                                            atol=1e-4), axis=1)):
-                                c_flag = 1
-                                break
-                        c_indices = constraints_ads[0]
-                        constrained_positions = surf_ads[c_indices].positions
-                        empty_positions = surf_empty.positions
-                        for cp in constrained_positions:
-                            if c_flag:
-                                break
-                            if not np.any(np.all(np.isclose(cp, empty_positions,
-                                                            atol=1e-4), axis=1)):
-                                c_flag = 1
-                                break
-
-                    if c_flag:
-                        if options.verbose:
-                            print("\n        -Warning: Not included."
-                                  " different constraint settings detected for"
-                                  " {} vs {}".format(surf_empty.info['filename'],
-                                                     surf_ads.info['filename']))
-                        continue
+                if constraint_flags[k]:
+                    if options.verbose:
+                        print("\n        -Warning: Not included."
+                              " different constraint settings detected for"
+                              " {} vs {}".format(surf_empty.info['filename'],
+                                                 surf_ads.info['filename']))
+                    continue
 
-                atomic_num_ads = sorted(surf_ads.numbers)
-                atomic_num_surf = sorted(surf_empty.numbers)
-
-                diff_numbers = atomic_num_ads.copy()
-                equal_numbers = []
-                for n in atomic_num_surf:
-                    if n in diff_numbers:
-                        diff_numbers.remove(n)
-                        equal_numbers += [n]
-                if not sorted(equal_numbers) ==\
-                   sorted(atomic_num_surf):
+                if not contains_empty[k]:
                     continue
 
-                distances, distances_abs = \
-                    get_distances(
-                        surf_ads.get_positions(),
-                        surf_empty.get_positions(),
-                        cell=surf_ads.cell, pbc=True)
+                diff_numbers = np.repeat(np.arange(max_number + 1),
+                                         counts[j] - counts[i_empty]).tolist()
 
-                min_dist = np.min(distances_abs, axis=1)
-                ads_pos_idx = np.where(
-                    min_dist > options.reorganization_tol)[0]
+                ads_pos_idx = displaced_atoms.get(j)
+                if ads_pos_idx is None:
+                    ads_pos_idx, = get_displaced_atoms(
+                        [surf_ads], surf_empty, options.reorganization_tol)
                 ads_pos_numbers = sorted(
                     surf_ads.get_atomic_numbers()[ads_pos_idx])
 
@@ -267,9 +283,6 @@ def fuzzy_match(structures, options):
                             "        -Skipping due to structural mismatch. \n include by increasing 'cathub -rtol ' ")
                     continue
 
-                equal_formula = get_reduced_chemical_formula(
-                    ase.atoms.Atoms(equal_numbers))
-
                 red_diff_numbers, rep = \
                     cathub.ase_tools.get_reduced_numbers(diff_numbers)
 
@@ -300,17 +313,19 @@ def fuzzy_match(structures, options):
                     adsorbate_input_idx = adsorbate_numbers.index(diff_numbers)
                     adsorbate = options.adsorbates[adsorbate_input_idx]
 
-                tags = [1 if i in ads_pos_idx else 0 for i,
-                        a in enumerate(surf_ads)]
+                tags = np.zeros(len(surf_ads), int)
+                tags[ads_pos_idx] = 1
+                surf_ads = copy_atoms(surf_ads)
                 surf_ads.set_tags(tags)
 
-                dE = surf_ads.get_potential_energy() \
-                    - surf_empty.get_potential_energy()
+                dE = energies[j] - energies[i_empty]
 
-                references, prefactors = \
-                    gas_phase_references \
-                    .construct_reference_system(adsorbate,
-                                                gas_phase_candidates)
+                if adsorbate not in reference_systems:
+                    reference_systems[adsorbate] = \
+                        gas_phase_references \
+                        .construct_reference_system(adsorbate,
+                                                    gas_phase_candidates)
+                references, prefactors = reference_systems[adsorbate]
 
                 if not references:
                     print(
@@ -352,7 +367,7 @@ def fuzzy_match(structures, options):
                 key = equal_formula
                 if options.keep_all_slabs and options.keep_all_energies:
                     key = get_chemical_formula(
-                        surf_empty) + '_Epot=' + str(round(surf_empty.get_potential_energy(), 4))
+                        surf_empty) + '_Epot=' + str(round(energies[i_empty], 4))
 
                 if options.keep_all_energies:
                     n_energies = len(collected_energies.get(
@@ -471,6 +486,108 @@ def fuzzy_match(structures, options):
     return collected_structures
 
 
+def group_by_volume(volumes, tolerance=1e-5):
+    """
+    Group volumes within tolerance of the smallest volume of a group.
+
+    Volumes are sorted and swept: a volume starts a new group unless it
+    is within tolerance of the first volume of the current group, which
+    is the only one of the previous groups it can be close to.
+
+    Returns dict of first volume: indices of the volumes in the group,
+    in order of increasing volume
+    """
+    volume_groups = {}
+    volume = None
+    for n in np.argsort(volumes, kind='stable'):
+        if volume is None or not abs(volume - volumes[n]) < tolerance:
+            volume = volumes[n]
+            volume_groups[volume] = []
+        volume_groups[volume].append(n)
+    return volume_groups
+
+
+def get_fixed_positions(atoms):
+    """Positions of the atoms fixed by the first FixAtoms constraint,
+    or None"""
+    for c in atoms.constraints:
+        if c.todict()['name'] == 'FixAtoms':
+            return atoms.positions[c.todict()['kwargs']['indices']]
+    return None
+
+
+def get_position_keys(positions, atol=1e-4):
+    """Positions rounded to a grid of spacing atol, as tuples. Positions
+    with equal keys are within atol of each other."""
+    return list(map(tuple, np.round(positions / atol).astype(int)))
+
+
+def positions_match(positions, keys, atoms, atoms_keys, atol=1e-4):
+    """
+    Whether each of positions is within atol of a position in atoms.
+
+    Positions are first looked up by their keys (see get_position_keys)
+    in the set atoms_keys of atoms. Only the remaining ones are compared
+    to all positions of atoms.
+    """
+    if atoms_keys.issuperset(keys):
+        return True
+    remaining = [p for p, key in zip(positions, keys)
+                 if key not in atoms_keys]
+    close = np.all(np.isclose(np.array(remaining)[:, None],
+                              atoms.positions[None], atol=atol), axis=2)
+    return bool(np.all(np.any(close, axis=1)))
+
+
+def get_displaced_atoms(surfaces, surf_empty, tolerance, max_pairs=100000):
+    """
+    For each surface, indices of the atoms further than tolerance from
+    any atom of surf_empty, using the minimum image convention in the
+    cell of the surface.
+
+    Distances are first bounded from above with the wrapped fractional
+    differences, for batches of surfaces with the same cell of at most
+    max_pairs atom pairs. Only atoms with a bound above tolerance are
+    checked with get_distances.
+
+    Returns list of index arrays, in the same order as surfaces
+    """
+    displaced = [None] * len(surfaces)
+    groups = {}
+    for n, surface in enumerate(surfaces):
+        groups.setdefault(surface.cell.array.tobytes(), []).append(n)
+    empty_positions = surf_empty.get_positions()
+    batch_size = max(1, max_pairs // max(1, len(surf_empty)))
+    for indices in groups.values():
+        cell = surfaces[indices[0]].cell
+        inverse_cell = np.linalg.inv(cell.array)
+        batch = []
+        for n in indices + [None]:
+            if n is not None and sum([len(surfaces[m]) for m in batch]) \
+                    + len(surfaces[n]) <= batch_size:
+                batch.append(n)
+                continue
+            if batch:
+                positions = np.concatenate([surfaces[m].get_positions()
+                                            for m in batch])
+                scaled = np.dot(positions[:, None] - empty_positions[None],
+                                inverse_cell)
+                scaled -= np.round(scaled)
+                upper_bound = np.linalg.norm(np.dot(scaled, cell.array),
+                                             axis=2).min(axis=1)
+                # Margin for rounding differences to get_distances
+                idx = np.where(upper_bound > tolerance - 1e-8)[0]
+                if len(idx):
+                    distances, distances_abs = get_distances(
+                        positions[idx], empty_positions, cell=cell, pbc=True)
+                    idx = idx[np.min(distances_abs, axis=1) > tolerance]
+                offsets = np.cumsum([0] + [len(surfaces[m]) for m in batch])
+                for m, start, end in zip(batch, offsets[:-1], offsets[1:]):
+                    displaced[m] = idx[(idx >= start) & (idx < end)] - start
+            batch = [n] if n is not None else []
+    return displaced
+
+
 def dict_representer(dumper, data):
     return dumper.represent_dict(data.items())
 
@@ -516,9 +633,16 @@ def main(options):
         '/').strip('.').rstrip('/') + '.cache.pckl'
 
     file_extensions = options.file_extensions.split(',')
+    workers = getattr(options, 'workers', 1)
+    cache = options.foldername if getattr(options, 'use_cache', False) \
+        else None
     structures = list(collect_structures(options.foldername,
                                          options.verbose,
-                                         file_extensions=file_extensions))
+                                         file_extensions=file_extensions,
+                                         workers=workers,
+                                         cache=cache,
+                                         clear_cache=getattr(
+                                             options, 'clear_cache', False)))
 
     if options.gas_dir:
         for extra_dir in options.gas_dir.split(','):
@@ -526,7 +650,9 @@ def main(options):
                 list(collect_structures(
                     extra_dir,
                     options.verbose,
-                    file_extensions=file_extensions))
+                    file_extensions=file_extensions,
+                    workers=workers,
+                    cache=cache))
             )
 
     publication_template = cathub.ase_tools.PUBLICATION_TEMPLATE
@@ -1,19 +1,27 @@
 import os
+import io
 import sys
+import csv
 import time
 import json
 import random
+import numbers
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import psycopg2
 from psycopg2.extras import execute_values
 import ase.db
 from ase.db.core import now
+from ase.db.sqlite import float_if_not_none
 from ase.db.postgresql import PostgreSQLDatabase
+from ase.data import atomic_numbers
 from past.utils import PY2
 
-from .cathubsqlite import CathubSQLite
+from .cathubsqlite import CathubSQLite, decompress_log
 from .config import server_name, public_access
+from .engines import get_engine
 
 init_commands = [
     """CREATE TABLE publication (
@@ -52,7 +60,8 @@ init_commands = [
     dft_code text,
     dft_functional text,
     username text,
-    pub_id text REFERENCES publication (pub_id) ON DELETE CASCADE
+    pub_id text REFERENCES publication (pub_id) ON DELETE CASCADE,
+    elements text[]
     );""",
 
     """CREATE TABLE reaction_system (
@@ -63,10 +72,19 @@ init_commands = [
     PRIMARY KEY (id, ase_id)
     )""",
 
+    """CREATE TABLE log_blob (
+    hash text PRIMARY KEY,
+    codec text,
+    logfile BYTEA
+    )""",
+
     """CREATE TABLE log (
-    ase_id text PRIMARY KEY REFERENCES systems(unique_id) ON DELETE CASCADE,
+    ase_id text REFERENCES systems(unique_id) ON DELETE CASCADE,
     logtype text,
-    logfile BYTEA
+    logfile BYTEA,
+    codec text,
+    hash text REFERENCES log_blob(hash),
+    PRIMARY KEY (ase_id, logtype)
     )""",
 ]
 
@@ -103,6 +121,30 @@ tsvector_statements = [
 
     'CREATE INDEX idxsearch ON reaction USING GIN (textsearch);'
 ]
+# Elements in chemical_composition, for indexed element search
+elements_statements = [
+    """CREATE OR REPLACE FUNCTION reaction_elements() RETURNS trigger AS $$
+    BEGIN
+    NEW.elements := ARRAY(SELECT DISTINCT
+    (regexp_matches(NEW.chemical_composition, '[A-Z][a-z]?', 'g'))[1]);
+    RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;""",
+
+    """CREATE TRIGGER reactionelements
+    BEFORE INSERT OR UPDATE OF chemical_composition ON reaction
+    FOR EACH ROW EXECUTE PROCEDURE reaction_elements();""",
+
+    'CREATE INDEX idxelements ON reaction USING GIN (elements);'
+]
+
+checkpoint_command = """CREATE TABLE IF NOT EXISTS transfer_checkpoint (
+    name text,
+    phase text,
+    last_id integer,
+    PRIMARY KEY (name, phase)
+    );"""
+
 tsvector_update = [
     """UPDATE publication SET pubtextsearch =
     to_tsvector('simple', coalesce(title, '') || ' ' ||
@@ -168,12 +210,10 @@ class CathubPostgreSQL:
             self.user, self.password, self.server, self.database)
 
     def _connect(self):
-        con = psycopg2.connect(host=self.server,
-                               user=self.user,
-                               password=self.password,
-                               port=5432,
-                               database=self.database)
-        return con
+        """psycopg2 connection from the shared connection pool.
+        close() returns it to the pool"""
+        engine = get_engine(self.server_name, schema=self.schema)
+        return engine.raw_connection()
 
     def __enter__(self):
         assert self.connection is None
@@ -222,10 +262,62 @@ class CathubPostgreSQL:
             for statement in tsvector_statements:
                 self.stdout.write(statement + '\n')
                 cur.execute(statement)
+            for statement in elements_statements:
+                cur.execute(statement)
             con.commit()
+        else:
+            try:
+                self._migrate(con)
+            except psycopg2.errors.InsufficientPrivilege:
+                # read-only users work with the schema as it is
+                con.rollback()
         self.initialized = True
         return self
 
+    def _migrate(self, con):
+        """Update tables written with an older schema"""
+        cur = con.cursor()
+        cur.execute("""SELECT count(*) FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = 'reaction'
+        AND column_name = 'elements';""", [self.schema])
+        if cur.fetchone()[0] == 0:
+            self.stdout.write("_initialize add elements column\n")
+            cur.execute('ALTER TABLE reaction ADD COLUMN elements text[];')
+            for statement in elements_statements:
+                cur.execute(statement)
+            # fill in existing rows through the trigger
+            cur.execute('UPDATE reaction SET chemical_composition = '
+                        'chemical_composition;')
+            con.commit()
+        cur.execute("""SELECT column_name FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = 'log';""",
+                    [self.schema])
+        log_columns = [row[0] for row in cur.fetchall()]
+        if 'hash' not in log_columns:
+            # Logs written before compression and deduplication
+            # are kept in the log table as they are
+            cur.execute(init_commands[-2].replace(
+                'CREATE TABLE', 'CREATE TABLE IF NOT EXISTS'))
+            if 'codec' not in log_columns:
+                cur.execute('ALTER TABLE log ADD COLUMN codec text;')
+            cur.execute('ALTER TABLE log ADD COLUMN hash text '
+                        'REFERENCES log_blob(hash);')
+            con.commit()
+        cur.execute("""SELECT c.conname, array_agg(a.attname::text)
+        FROM pg_constraint AS c JOIN pg_attribute AS a
+        ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+        WHERE c.conrelid = 'log'::regclass AND c.contype = 'p'
+        GROUP BY c.conname;""")
+        row = cur.fetchone()
+        if row is not None and row[1] == ['ase_id']:
+            # One log per structure was kept before, allow one per logtype
+            self.stdout.write("_initialize change log primary key\n")
+            cur.execute('ALTER TABLE log DROP CONSTRAINT {0};'
+                        .format(row[0]))
+            cur.execute("UPDATE log SET logtype = '' WHERE logtype IS NULL;")
+            cur.execute('ALTER TABLE log ADD PRIMARY KEY (ase_id, logtype);')
+            con.commit()
+
     def get_ase_db(self):
         if not self.connection:
             self._connect()
@@ -571,6 +663,19 @@ class CathubPostgreSQL:
 
         return columns, row
 
+    def read_log(self, ase_id):
+        """ Return (logtype, logfile) of all logs for a structure,
+        decompressed"""
+        con = self.connection or self._connect()
+        self._initialize(con)
+        cur = con.cursor()
+        cur.execute("""SELECT l.logtype,
+        coalesce(l.logfile, b.logfile), coalesce(l.codec, b.codec)
+        FROM log AS l LEFT JOIN log_blob AS b ON l.hash = b.hash
+        WHERE l.ase_id=%s;""", [ase_id])
+        return [(logtype, decompress_log(logfile, codec))
+                for logtype, logfile, codec in cur.fetchall()]
+
     def write_publication(self, pub_values):
         con = self.connection or self._connect()
         self._initialize(con)
@@ -775,19 +880,145 @@ class CathubPostgreSQL:
 
         cur.execute('DELETE FROM publication;')
         cur.execute('TRUNCATE systems CASCADE;')
+        cur.execute('TRUNCATE log_blob CASCADE;')
 
         con.commit()
         con.close()
 
         return
 
+    def copy_systems(self, cur, rows):
+        """ Bulk load ASE rows into the systems, species, keys and
+        key-value tables with COPY.
+
+        New ids are reserved from the systems sequence, and the values
+        are the ones ase.db would write for each row.
+
+        Parameters:
+        cur: psycopg2 cursor
+        rows: list of ase.db.row.AtomsRow
+        """
+        if len(rows) == 0:
+            return []
+        cur.execute("""SELECT nextval('systems_id_seq')
+        FROM generate_series(1, %s);""", [len(rows)])
+        ids = [r[0] for r in cur.fetchall()]
+
+        db_ase = PostgreSQLDatabase(self.server_name)  # for encoding only
+        mtime = now()
+        systems_values = []
+        species_values = []
+        keys_values = []
+        text_key_values = []
+        number_key_values = []
+        for id, row in zip(ids, rows):
+            systems_values += [get_systems_values(row, id, mtime, db_ase)]
+            species_values += [(atomic_numbers[symbol], n, id)
+                               for symbol, n in row.count_atoms().items()]
+            for key, value in row.key_value_pairs.items():
+                keys_values += [(key, id)]
+                if isinstance(value, (numbers.Real, np.bool_)):
+                    number_key_values += [(key, float(value), id)]
+                else:
+                    text_key_values += [(key, value, id)]
+
+        copy_rows(cur, 'systems', get_key_list('systems'), systems_values)
+        copy_rows(cur, 'species', ['z', 'n', 'id'], species_values)
+        copy_rows(cur, 'keys', ['key', 'id'], keys_values)
+        copy_rows(cur, 'text_key_values', ['key', 'value', 'id'],
+                  text_key_values)
+        copy_rows(cur, 'number_key_values', ['key', 'value', 'id'],
+                  number_key_values)
+        return ids
+
+    def _connect_schema(self):
+        """ New connection with search path set to the schema. It is
+        opened outside the shared pool, so that any number of transfer
+        workers can hold one next to the pooled connections"""
+        con = psycopg2.connect(self.server_name)
+        cur = con.cursor()
+        cur.execute('SET search_path TO {0};'.format(self.schema))
+        con.commit()
+        return con
+
+    def _transfer_blocks(self, con, name, phase, blocks, write_block,
+                         workers=1):
+        """ Call write_block(cur, block) for each (first id, last id)
+        block, commit and record progress in the checkpoint.
+
+        With more than one worker the blocks are written in parallel on
+        separate, non-pooled connections. Results are yielded in block order, and the
+        checkpoint is only moved past blocks that have all been committed.
+
+        Yields (block, return value of write_block)
+        """
+        if workers < 2 or len(blocks) < 2:
+            cur = con.cursor()
+            for block in blocks:
+                n = write_block(cur, block)
+                self._set_checkpoint(cur, name, phase, block[1])
+                con.commit()
+                yield block, n
+            return
+
+        local = threading.local()
+        connections = []
+
+        def run(block):
+            if not hasattr(local, 'con'):
+                local.con = self._connect_schema()
+                connections.append(local.con)
+            try:
+                n = write_block(local.con.cursor(), block)
+                local.con.commit()
+            except BaseException:
+                local.con.rollback()
+                raise
+            return n
+
+        cur = con.cursor()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(run, block) for block in blocks]
+                for block, future in zip(blocks, futures):
+                    n = future.result()
+                    self._set_checkpoint(cur, name, phase, block[1])
+                    con.commit()
+                    yield block, n
+        finally:
+            for worker_con in connections:
+                worker_con.close()
+
+    def _get_checkpoint(self, cur, name):
+        """ Progress of earlier transfers of the same data, as a dict
+        with the last transferred (sqlite) id for each table"""
+        cur.execute(checkpoint_command)
+        cur.execute(
+            'SELECT phase, last_id FROM transfer_checkpoint WHERE name=%s;',
+            [name])
+        return dict(cur.fetchall())
+
+    def _set_checkpoint(self, cur, name, phase, last_id):
+        """ Record progress. Must be executed in the same transaction
+        as the block of data it refers to."""
+        cur.execute(
+            """INSERT INTO transfer_checkpoint (name, phase, last_id)
+            VALUES (%s, %s, %s) ON CONFLICT (name, phase)
+            DO UPDATE SET last_id = EXCLUDED.last_id;""",
+            [name, phase, last_id])
+
     def transfer(self, filename_sqlite, block_size=1000,
                  start_block=0, write_ase=True,
                  write_publication=True, write_reaction=True,
-                 write_reaction_system=True, write_log=True, check=False):
+                 write_reaction_system=True, write_log=True, check=False,
+                 resume=False, workers=1, log_block_bytes=100 * 1024**2):
         """ Transfer data from local sqlite3 .db file to the
         catalysis-hub postgreSQL server
 
+        Progress is recorded in the transfer_checkpoint table in the same
+        transaction as each block, so that an interrupted transfer can be
+        continued with resume=True without writing any row twice.
+
         Parameters:
         filename_sqlite: str
             name of .db file
@@ -806,6 +1037,17 @@ class CathubPostgreSQL:
             whether or not to write reaction_system table
         write_log: bool
             whether or not to write log table
+        resume: bool
+            continue after the last block recorded in the checkpoint
+            of an earlier transfer of the same data
+        workers: int
+            Number of connections used in parallel to write atomic
+            structures and logs
+        log_block_bytes: int (default 100 MB)
+            Maximum size of the output files read into memory together
+            for each block of logs. A single larger file is transferred
+            in a block of its own. Compressed logs are uploaded as they
+            are stored, together with their codec.
         """
 
         self.stdout.write('Starting transfer\n')
@@ -816,63 +1058,78 @@ class CathubPostgreSQL:
         self.stdout.write('Got a cursor\n')
         self.stdout.write('Connecting to {0}\n'.format(self.server_name))
 
+        db = CathubSQLite(filename_sqlite)
+        con_lite = db._connect()
+        db._initialize(con_lite)
+        cur_lite = con_lite.cursor()
+
+        cur_lite.execute('SELECT pub_id FROM publication ORDER BY id;')
+        name = ','.join([row[0] for row in cur_lite.fetchall()]) or \
+            os.path.basename(filename_sqlite)
+        checkpoint = self._get_checkpoint(cur, name)
+        if resume:
+            for phase, last_id in checkpoint.items():
+                self.stdout.write(
+                    'Resuming {0} after id {1}\n'.format(phase, last_id))
+        else:
+            cur.execute('DELETE FROM transfer_checkpoint WHERE name=%s;',
+                        [name])
+            checkpoint = {}
+        con.commit()
+
         nrows = 0
         if write_ase:
             self.stdout.write('Transfering atomic structures\n')
-            db = ase.db.connect(filename_sqlite)
-            n_structures = db.count()
-            n_blocks = n_structures // block_size + 1
-            t_av = 0
-            for block_id in range(start_block, n_blocks):
-                i = block_id - start_block
-                t1 = time.time()
-                b0 = block_id * block_size
-                b1 = (block_id + 1) * block_size + 1
-
-                if block_id + 1 == n_blocks:
-                    b1 = n_structures + 1
-
-                rows = list(db.select('{}<id<{}'.format(b0, b1)))
+            db_ase = ase.db.connect(filename_sqlite)
+            cur_lite.execute('SELECT max(id) FROM systems;')
+            n_structures = cur_lite.fetchone()[0] or 0
+            first_id = max(start_block * block_size,
+                           checkpoint.get('systems', 0)) + 1
+            blocks = [(b0, min(b0 + block_size - 1, n_structures))
+                      for b0 in range(first_id, n_structures + 1, block_size)]
+
+            def write_systems(cur, block):
+                rows = list(db_ase.select('{}<=id<={}'.format(*block)))
+
+                # skip structures already on the server
+                cur.execute(
+                    'SELECT unique_id FROM systems WHERE unique_id = ANY(%s);',
+                    [[row.unique_id for row in rows]])
+                existing = set([r[0] for r in cur.fetchall()])
+                rows = [row for row in rows if row.unique_id not in existing]
 
-                with ase.db.connect(self.server_name, type='postgresql') as db2:
-                    # write one row at the time until ase is updated
-                    # db2.write(rows)
-                    for row in rows:
-                        db2.write(row, data=row.data)
+                self.copy_systems(cur, rows)
+                return len(rows)
 
-                nrows += len(rows)
+            t_av = 0
+            t1 = time.time()
+            for i, (block, n) in enumerate(self._transfer_blocks(
+                    con, name, 'systems', blocks, write_systems, workers)):
+                nrows += n
                 t2 = time.time()
                 dt = t2 - t1
+                t1 = t2
                 t_av = (t_av * i + dt) / (i + 1)
 
                 self.stdout.write(
-                    '  Finnished Block {0} / {1} in {2} sec\n'
-                    .format(block_id + 1, n_blocks, dt))
+                    '  Finnished Block {0} / {1} in {2} sec ({3:.0f} rows/sec)\n'
+                    .format(i + 1, len(blocks), dt, n / max(dt, 1e-3)))
                 self.stdout.write(
                     '    Completed transfer of {0} atomic structures\n'
                     .format(nrows))
                 self.stdout.write('    Estimated time left: {0} sec\n'.format(
-                    t_av * (n_blocks - block_id - 1)))
-
-        db = CathubSQLite(filename_sqlite)
-        con_lite = db._connect()
-        cur_lite = con_lite.cursor()
+                    t_av * (len(blocks) - i - 1)))
 
         Npub = 0
         Npubstruc = 0
         if write_publication:
             self.stdout.write('Transfering publications\n')
-            try:
-                npub = db.get_last_pub_id(cur_lite)
-            except BaseException:
-                npub = 1
-            for id_lite in range(1, npub + 1):
+            cur_lite.execute('SELECT * FROM publication ORDER BY id;')
+            pub_ids = []
+            for row in cur_lite.fetchall():
                 Npub += 1
-                row = db.read(id=id_lite, table='publication')
-                if len(row) == 0:
-                    continue
-                values = row[0]
-                pid, pub_id = self.write_publication(values)
+                pid, pub_id = self.write_publication(row)
+                pub_ids += [pub_id]
 
             # Publication structures connection
             cur_lite.execute("""SELECT * from publication_system;""")
@@ -885,44 +1142,84 @@ class CathubPostgreSQL:
                 publication_system_values += [tuple(value_list)]
 
             # Insert into publication_system table
-            key_str = get_key_str(table='publication_system')
-            insert_command = """INSERT INTO publication_system ({0})
-            VALUES %s ON CONFLICT DO NOTHING;"""\
-                .format(key_str)
-
-            execute_values(cur=cur, sql=insert_command,
-                           argslist=publication_system_values, page_size=1000)
+            copy_rows(cur, 'publication_system',
+                      get_key_list('publication_system'),
+                      publication_system_values,
+                      on_conflict=['pub_id', 'ase_id'])
 
             # Write pub_id to systems table
-            cur.execute("""UPDATE systems SET
-            key_value_pairs=jsonb_set(key_value_pairs, '{{"pub_id"}}', '"{pub_id}"')
-            WHERE unique_id IN
-            (SELECT ase_id from publication_system WHERE pub_id='{pub_id}')"""
-                        .format(pub_id=pub_id))
+            for pub_id in pub_ids:
+                cur.execute("""UPDATE systems SET
+                key_value_pairs=jsonb_set(key_value_pairs, '{{"pub_id"}}', '"{pub_id}"')
+                WHERE unique_id IN
+                (SELECT ase_id from publication_system WHERE pub_id='{pub_id}')"""
+                            .format(pub_id=pub_id))
 
             con.commit()
             self.stdout.write('  Completed transfer of publications\n')
 
-
         Nlogs = 0
         if write_log:
-            cur_lite.execute("""SELECT * from log;""")
-            log_values = []
-            rows = cur_lite.fetchall()
-            log_values = []
-            for row in rows:
-                Nlogs += 1
-                values = list(row)
-                log_values += [tuble(values)]
-
-            key_str = get_key_str(table='log')
-            insert_command = """INSERT INTO log ({0})
-            VALUES %s;"""\
-                .format(key_str)
-
-            execute_values(cur=cur, sql=insert_command,
-                           argslist=log_values)
-            con.commit()
+            def write_log_blobs(cur, block):
+                con_log = db._connect()
+                cur_log = con_log.execute(
+                    'SELECT hash FROM log_blob WHERE rowid BETWEEN ? AND ?;',
+                    block)
+                hashes = [row[0] for row in cur_log.fetchall()]
+
+                # skip content already on the server
+                cur.execute(
+                    'SELECT hash FROM log_blob WHERE hash = ANY(%s);',
+                    [hashes])
+                existing = set([r[0] for r in cur.fetchall()])
+                cur_log = con_log.execute(
+                    'SELECT hash, codec, logfile FROM log_blob '
+                    'WHERE rowid BETWEEN ? AND ?;', block)
+                blob_values = [row for row in cur_log
+                               if row[0] not in existing]
+                con_log.close()
+                copy_rows(cur, 'log_blob', get_key_list('log_blob'),
+                          blob_values, on_conflict=['hash'])
+                return len(hashes)
+
+            def write_logs(cur, block):
+                con_log = db._connect()
+                log_values = con_log.execute(
+                    "SELECT ase_id, coalesce(logtype, ''), logfile, codec, "
+                    "hash FROM log WHERE rowid BETWEEN ? AND ?;",
+                    block).fetchall()
+                con_log.close()
+                return copy_rows(cur, 'log', get_key_list('log'), log_values,
+                                 on_conflict=['ase_id', 'logtype'])
+
+            # Content is written before the logs that reference it
+            for table, write_block in [('log_blob', write_log_blobs),
+                                       ('log', write_logs)]:
+                self.stdout.write('Transfering {0}\n'.format(table))
+                blocks, block_bytes = get_log_blocks(
+                    cur_lite, table, checkpoint.get(table, 0),
+                    block_size, log_block_bytes)
+
+                total_bytes = sum(block_bytes)
+                N_bytes = 0
+                N_rows = 0
+                t0 = time.time()
+                for i, (block, n) in enumerate(self._transfer_blocks(
+                        con, name, table, blocks, write_block, workers)):
+                    N_rows += n
+                    N_bytes += block_bytes[i]
+                    dt = time.time() - t0
+                    self.stdout.write(
+                        '  Finnished {0} block {1} / {2}: {3:.1f} / {4:.1f} MB '
+                        '({5:.1f} MB/sec, {6:.0f} rows/sec)\n'
+                        .format(table, i + 1, len(blocks), N_bytes / 1e6,
+                                total_bytes / 1e6,
+                                N_bytes / 1e6 / max(dt, 1e-3),
+                                N_rows / max(dt, 1e-3)))
+                self.stdout.write('  Completed transfer of {0} {1} rows\n'
+                                  .format(N_rows, table))
+                if table == 'log':
+                    Nlogs = N_rows
 
         Ncat = 0
         Ncatstruc = 0
@@ -932,86 +1229,71 @@ class CathubPostgreSQL:
             cur.execute('SELECT max(id) from reaction;')
             ID = cur.fetchone()[0] or 0
 
-            n_react = db.get_last_id(cur_lite)
+            last_id = max(start_block * block_size,
+                          checkpoint.get('reaction', 0))
+            cur_lite.execute('SELECT count(*) FROM reaction WHERE id > ?;',
+                             [last_id])
+            n_blocks = (cur_lite.fetchone()[0] - 1) // block_size + 1
+
+            # Stream both tables ordered by reaction id and join them here,
+            # instead of one query per reaction
+            cur_lite.execute('SELECT * FROM reaction WHERE id > ? ORDER BY id;',
+                             [last_id])
+            cur_rs = con_lite.cursor()
+            cur_rs.execute("""SELECT * FROM reaction_system WHERE id > ?
+            ORDER BY id;""", [last_id])
+            rs_row = next(cur_rs, None)
 
-            n_blocks = int(n_react / block_size) + 1
             t_av = 0
-            for block_id in range(start_block, n_blocks):
+            for block_id in range(n_blocks):
                 reaction_values = []
                 reaction_system_values = []
                 Ncat0 = Ncat
                 Ncatstruc0 = Ncatstruc
-
-                i = block_id - start_block
                 t1 = time.time()
-                b0 = block_id * block_size + 1
-                b1 = (block_id + 1) * block_size + 1
-                if block_id + 1 == n_blocks:
-                    b1 = n_react + 1
-
-                for id_lite in range(b0, b1):
-                    row = db.read(id_lite)
-                    if len(row) == 0:
-                        continue
-                    values = row[0]
-
-                    id = None
-                    update_rs = False
-                    if id is not None:
-                        id = self.update(id, values)
-                        self.stdout.write(
-                            'Updated reaction db with row id = {}\n'
-                            .format(id))
-                        update_rs = True
-                    else:
-                        ID += 1
-                        Ncat += 1
-                        value_list = get_value_list(values)
-                        value_list[0] = ID  # set new ID
-                        reaction_values += [tuple(value_list)]
-                        if write_reaction_system:
-                            cur_lite.execute("SELECT * from reaction_system where id={};"
-                                             .format(id_lite))
-                            rows = cur_lite.fetchall()
-                            if update_rs:
-                                cur.execute("""Delete from reaction_system
-                                where id={0}""".format(id))
-                            for row in rows:
-                                Ncatstruc += 1
-                                values = list(row)
-                                if len(values) == 3:
-                                    values.insert(1, None)
-                                value_list = get_value_list(values)
-                                value_list[3] = ID
-                                reaction_system_values += [tuple(value_list)]
-
-                q = ', '.join('?' * 14)
-                q = '({})'.format(q.replace('?', '%s'))
-
-                key_str = get_key_str()
-                insert_command = """INSERT INTO reaction
-                ({0}) VALUES %s;""".format(key_str)
-
-                execute_values(cur=cur, sql=insert_command,
-                               argslist=reaction_values,
-                               template=q, page_size=block_size)
-
-                key_str = get_key_str('reaction_system')
-                insert_command = """INSERT INTO reaction_system
-                ({0}) VALUES %s ON CONFLICT DO NOTHING;""".format(key_str)
-
-                execute_values(cur=cur, sql=insert_command,
-                               argslist=reaction_system_values,
-                               page_size=1000)
+
+                rows = cur_lite.fetchmany(block_size)
+                for row in rows:
+                    id_lite = row[0]
+                    # skip columns only used locally, such as fingerprint
+                    values = row[:len(get_key_list())]
+                    ID += 1
+                    Ncat += 1
+                    value_list = get_value_list(values)
+                    value_list[0] = ID  # set new ID
+                    reaction_values += [tuple(value_list)]
+
+                    # id is the last column, also in the old 3-column format
+                    while rs_row is not None and rs_row[-1] <= id_lite:
+                        if rs_row[-1] == id_lite and write_reaction_system:
+                            Ncatstruc += 1
+                            values = list(rs_row)
+                            if len(values) == 3:
+                                values.insert(1, None)
+                            value_list = get_value_list(values)
+                            value_list[3] = ID
+                            reaction_system_values += [tuple(value_list)]
+                        rs_row = next(cur_rs, None)
+
+                copy_rows(cur, 'reaction', get_key_list(), reaction_values)
+                copy_rows(cur, 'reaction_system',
+                          get_key_list('reaction_system'),
+                          reaction_system_values,
+                          on_conflict=['id', 'ase_id'])
+                # ids were set explicitly, keep the sequence ahead of them
+                cur.execute("""SELECT setval('reaction_id_seq',
+                (SELECT max(id) FROM reaction));""")
+                self._set_checkpoint(cur, name, 'reaction', rows[-1][0])
                 con.commit()
 
                 t2 = time.time()
                 dt = t2 - t1
-                t_av = (t_av * i + dt) / (i + 1)
+                t_av = (t_av * block_id + dt) / (block_id + 1)
 
                 self.stdout.write(
-                    '  Finnished Block {0} / {1} in {2} sec \n'
-                    .format(block_id + 1, n_blocks, dt))
+                    '  Finnished Block {0} / {1} in {2} sec ({3:.0f} rows/sec)\n'
+                    .format(block_id + 1, n_blocks, dt,
+                            (Ncat - Ncat0 + Ncatstruc - Ncatstruc0) / max(dt, 1e-3)))
                 self.stdout.write(
                     '    Completed transfer of {0} reactions. \n'
                     .format(Ncat - Ncat0))
@@ -1033,6 +1315,7 @@ class CathubPostgreSQL:
         self.stdout.write('  publication_system: {0}\n'.format(Npubstruc))
         self.stdout.write('  reaction: {0}\n'.format(Ncat))
         self.stdout.write('  reaction_system: {0}\n'.format(Ncatstruc))
+        self.stdout.write('  log: {0}\n'.format(Nlogs))
 
     def check(self, pub_id, chemical_composition, reactants, products,
               sites=None, reaction_energy=None):
@@ -1109,7 +1392,8 @@ def get_key_list(table='reaction', start_index=0):
                             'forces', 'stress', 'dipole', 'magmoms', 'magmom',
                             'charges', 'key_value_pairs', 'data', 'natoms',
                             'fmax', 'smax', 'volume', 'mass', 'charge'],
-                'log': ['ase_id', 'logtype', 'logfile']
+                'log_blob': ['hash', 'codec', 'logfile'],
+                'log': ['ase_id', 'logtype', 'logfile', 'codec', 'hash']
                             }
 
     return key_list[table][start_index:]
@@ -1148,3 +1432,154 @@ def get_value_str(values, start_index=0):
         else:
             value_str += ", {0}".format(v)
     return value_str
+
+
+def get_systems_values(row, id, mtime, db):
+    """ Values of the systems table for an ase.db row,
+    following ase.db.sqlite.SQLite3Database._write """
+    encode = db.encode
+    blob = db.blob
+
+    constraints = row._constraints
+    if constraints:
+        if isinstance(constraints, list):
+            constraints = encode(constraints)
+    else:
+        constraints = None
+
+    values = (id,
+              row.unique_id,
+              row.ctime,
+              mtime,
+              row.user,
+              blob(row.numbers),
+              blob(row.positions),
+              blob(row.cell),
+              int(np.dot(row.pbc, [1, 2, 4])),
+              blob(row.get('initial_magmoms')),
+              blob(row.get('initial_charges')),
+              blob(row.get('masses')),
+              blob(row.get('tags')),
+              blob(row.get('momenta')),
+              constraints)
+
+    if 'calculator' in row:
+        values += (row.calculator, encode(row.calculator_parameters))
+    else:
+        values += (None, None)
+
+    values += (row.get('energy'),
+               row.get('free_energy'),
+               blob(row.get('forces')),
+               blob(row.get('stress')),
+               blob(row.get('dipole')),
+               blob(row.get('magmoms')),
+               row.get('magmom'),
+               blob(row.get('charges')),
+               encode(row.key_value_pairs),
+               encode(row.data),
+               len(row.numbers),
+               float_if_not_none(row.get('fmax')),
+               float_if_not_none(row.get('smax')),
+               float_if_not_none(row.get('volume')),
+               float(row.mass),
+               float(row.charge))
+    return values
+
+
+def get_log_blocks(cur_lite, table, last_id, block_size, max_bytes):
+    """ Split rows of the local log or log_blob table after last_id into
+    blocks of at most block_size rows and max_bytes of log files. A single
+    larger file is put in a block of its own.
+
+    Returns list of (first rowid, last rowid) and list of bytes per block
+    """
+    cur_lite.execute(
+        'SELECT rowid, length(logfile) FROM {0} WHERE rowid > ? '
+        'ORDER BY rowid;'.format(table), [last_id])
+    blocks = []
+    block_bytes = []
+    first_id = None
+    n_rows = 0
+    n_bytes = 0
+    for rowid, size in cur_lite.fetchall():
+        size = size or 0
+        if first_id is not None and \
+                (n_bytes + size > max_bytes or n_rows == block_size):
+            blocks += [(first_id, last_id)]
+            block_bytes += [n_bytes]
+            first_id = None
+        if first_id is None:
+            first_id = rowid
+            n_rows = 0
+            n_bytes = 0
+        last_id = rowid
+        n_rows += 1
+        n_bytes += size
+    if first_id is not None:
+        blocks += [(first_id, last_id)]
+        block_bytes += [n_bytes]
+    return blocks, block_bytes
+
+
+def get_copy_value(value):
+    """ Format a value for COPY ... WITH (FORMAT csv, NULL '\\N') """
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return get_array_str(value)
+    if isinstance(value, float) and np.isnan(value):
+        return '\\N'
+    return value
+
+
+def get_array_str(value):
+    """ Postgres array literal of (nested) list """
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join([get_array_str(v) for v in value]) + '}'
+    if value is None:
+        return 'NULL'
+    return repr(value)
+
+
+def copy_rows(cur, table, columns, rows, on_conflict=None):
+    """ Write rows to table with COPY FROM STDIN
+
+    Parameters:
+    cur: psycopg2 cursor
+    table: str
+    columns: list of str
+    rows: list of tuples
+    on_conflict: list of str
+        Key columns of a unique constraint. Rows with the same key as
+        an existing row are skipped: the rows are copied to a temporary
+        table first and inserted with ON CONFLICT (key) DO NOTHING.
+        Violations of other constraints raise an error.
+    """
+    if len(rows) == 0:
+        return 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([get_copy_value(v) for v in row])
+    buffer.seek(0)
+
+    key_str = ', '.join(columns)
+    target = table
+    if on_conflict:
+        target = 'copy_' + table
+        cur.execute("""CREATE TEMP TABLE IF NOT EXISTS {0}
+        (LIKE {1}) ON COMMIT DELETE ROWS;""".format(target, table))
+        cur.execute('TRUNCATE {0};'.format(target))
+
+    cur.copy_expert(
+        """COPY {0} ({1}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"""
+        .format(target, key_str), buffer)
+
+    if on_conflict:
+        cur.execute("""INSERT INTO {0} ({1}) SELECT {1} FROM {2}
+        ON CONFLICT ({3}) DO NOTHING;""".format(
+            table, key_str, target, ', '.join(on_conflict)))
+    return len(rows)
@@ -2,12 +2,20 @@
 import re
 import os
 import json
+import copy
+import asyncio
+import threading
+import weakref
 import requests
 import pprint
+import psycopg2
 import ase.db
+from concurrent.futures import ThreadPoolExecutor
 
 from cathub.cathubsqlite import CathubSQLite
 from cathub.postgresql import CathubPostgreSQL
+from cathub.cathubsql import get_atoms_rows
+from cathub.query_cache import QueryCache, normalize_query
 
 all_columns = {'reactions': ['chemicalComposition', 'surfaceComposition',
                              'facet', 'sites', 'coverages', 'reactants',
@@ -25,6 +33,32 @@ all_columns = {'reactions': ['chemicalComposition', 'surfaceComposition',
                'publicationSystems': ['pubId', 'aseId'],
                'logs': ['Logtext']}
 
+GRAPHQL_URL = 'http://api.catalysis-hub.org/graphql'
+
+_session = None
+query_cache = None
+
+
+def get_session():
+    """requests.Session shared by all queries, keeping the
+    connection to the server alive between requests"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def set_cache(enabled=True, **kwargs):
+    """
+    Turn the local cache of GraphQL responses and structure rows on
+    or off. Keyword arguments (filename, ttl, max_size) are passed
+    to QueryCache.
+    """
+    global query_cache
+    if query_cache is not None:
+        query_cache.close()
+    query_cache = QueryCache(**kwargs) if enabled else None
+
 
 def query(table='reactions',
           columns=['chemicalComposition',
@@ -33,12 +67,26 @@ def query(table='reactions',
           subtables=[],
           n_results=10,
           queries={},
-          print_output=False):
+          print_output=False,
+          page_size=None,
+          url=None):
+    """
+    Query the server and return the result as a nested dictionary.
 
+    If page_size is given, the results are fetched page by page with
+    cursor based pagination and collected into the same structure.
+    """
     if table == 'logs':
         query_string = graphql_query(table=table,
                                      columns=columns,
                                      queries=queries)
+    elif page_size is not None:
+        edges = [{'node': node} for node in
+                 iter_nodes(table=table, subtables=subtables,
+                            columns=columns, n_results=n_results,
+                            queries=queries, page_size=page_size,
+                            url=url)]
+        return {table: {'edges': edges}}
     else:
         query_string = graphql_query(table=table,
                                      subtables=subtables,
@@ -46,53 +94,146 @@ def query(table='reactions',
                                      n_results=n_results,
                                      queries=queries)
 
-    return execute_graphQL(query_string, table=table)
-
-
-def execute_graphQL(query_string, table=None):
-    root = 'http://api.catalysis-hub.org/graphql'
-    print('Connecting to database at {root}'.format(root=root))
-    print('')
-    print('Executing query:')
-    print('')
-    print(query_string)
-    print('')
-    print('Getting data from server...')
-    print('')
-    data = requests.post(root, {'query': query_string})
-    try:
-        data = data.json()['data']
-        print('Data fetched!')
-    except BaseException:
-        print(data)
+    return execute_graphQL(query_string, table=table, url=url)
+
+
+def execute_graphQL(query_string, table=None, url=None, verbose=True):
+    root = url or GRAPHQL_URL
+    if verbose:
+        print('Connecting to database at {root}'.format(root=root))
+        print('')
+        print('Executing query:')
+        print('')
+        print(query_string)
+        print('')
+        print('Getting data from server...')
+        print('')
+    data = None
+    if query_cache is not None:
+        data = query_cache.get_response(root, query_string)
+        if data is not None and verbose:
+            print('Data read from cache!')
+    if data is None:
+        data = get_session().post(root, {'query': query_string})
+        try:
+            data = data.json()['data']
+            if verbose:
+                print('Data fetched!')
+            if query_cache is not None and data is not None:
+                query_cache.set_response(root, query_string, data)
+        except BaseException:
+            print(data)
 
     if not table == 'logs':
-        # Load nested dictionaries
-        for i, node in enumerate(data['reactions']['edges']):
-            node = node['node']
-            for key, value in list(node.items()):
-                try:
-                    value_dict = json.loads(value)
-                    node[key] = value_dict
-                except (ValueError, TypeError):
-                    pass
+        load_nested(data, table)
 
     return data
 
 
+def load_nested(data, table):
+    """Load nested dictionaries of the nodes in data, in place"""
+    for i, node in enumerate(data[table]['edges']):
+        node = node['node']
+        for key, value in list(node.items()):
+            try:
+                value_dict = json.loads(value)
+                node[key] = value_dict
+            except (ValueError, TypeError):
+                pass
+
+
+def iter_nodes(table='reactions',
+               subtables=[],
+               columns=['chemicalComposition',
+                        'reactants',
+                        'products'],
+               n_results='all',
+               queries={},
+               page_size=100,
+               prefetch=True,
+               url=None):
+    """
+    Generator over the nodes of a query, fetched page by page.
+
+    Pages of page_size results are requested with the 'after' cursor
+    of the previous page, so large queries are never held in a single
+    response. With prefetch, the next page is requested in a
+    background thread while the current page is consumed.
+
+    Parameters
+    ----------
+    table: str
+        'reactions' or 'publications'
+    n_results: int or 'all'
+        maximum number of nodes to yield
+    page_size: int
+        number of nodes requested per page
+    prefetch: bool
+        request the next page while the current one is processed
+    url: str
+        GraphQL endpoint, defaults to GRAPHQL_URL
+    """
+    def fetch_page(cursor, n_page):
+        query_string = graphql_query(table=table,
+                                     subtables=subtables,
+                                     columns=columns,
+                                     n_results=n_page,
+                                     queries=queries,
+                                     after=cursor)
+        return execute_graphQL(query_string, table=table, url=url,
+                               verbose=False)[table]
+
+    def page_length(n_done):
+        if n_results == 'all':
+            return page_size
+        return min(page_size, n_results - n_done)
+
+    n = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = fetch_page(None, page_length(0))
+        while True:
+            edges = page['edges']
+            n_next = n + len(edges)
+            next_page = None
+            if edges and page['pageInfo']['hasNextPage'] \
+                    and page_length(n_next) > 0:
+                cursor = page['pageInfo']['endCursor']
+                if prefetch:
+                    next_page = executor.submit(fetch_page, cursor,
+                                                page_length(n_next))
+                else:
+                    next_page = cursor
+            for edge in edges:
+                yield edge['node']
+            n = n_next
+            if next_page is None:
+                break
+            if prefetch:
+                page = next_page.result()
+            else:
+                page = fetch_page(next_page, page_length(n))
+
+
 def graphql_query(table='reactions',
                   subtables=[],
                   columns=['chemicalComposition',
                            'reactants',
                            'products'],
                   n_results=10,
-                  queries={}):
-
+                  queries={},
+                  after=False):
+    """
+    GraphQL query string for table. If after is not False, a
+    paginated query is made: after is the cursor of the previous page
+    (None for the first page), and pageInfo is included in the result.
+    """
     statement = '{'
     statement += '{}('.format(table)
     if not table == 'logs':
         if n_results != 'all':
             statement += 'first: {}'.format(n_results)
+        if after:
+            statement += ', after: "{}"'.format(after)
     for key, value in queries.items():
         if isinstance(value, str):
             if table == 'logs':
@@ -111,7 +252,11 @@ def graphql_query(table='reactions',
     if table == 'logs':
         statement += ' edges {\n    node { \n'
     else:
-        statement += ' totalCount\n  edges {\n    node { \n'
+        if not after:
+            statement += ' totalCount\n'
+        if after is not False:
+            statement += '  pageInfo {\n    hasNextPage\n    endCursor\n  }\n'
+        statement += '  edges {\n    node { \n'
     for column in columns:
         column = map_column_names(column)
         statement += '      {}\n'.format(column)
@@ -134,25 +279,17 @@ def convert(name):
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
 
-def get_reactions(columns='all', n_results=20, write_db=False, **kwargs):
+def get_reactions(columns='all', n_results=20, write_db=False,
+                  page_size=None, **kwargs):
     """
     Get reactions from server
 
-    Give key value strings as arguments
+    Give key value strings as arguments. With page_size, the reactions
+    are fetched in pages of that size, see iter_nodes.
     """
     if write_db or columns == 'all':
         columns = all_columns['reactions']
-    queries = {}
-    for key, value in kwargs.items():
-        key = map_column_names(key)
-        if key == 'distinct':
-            if value in [True, 'True', 'true']:
-                queries.update({key: True})
-                continue
-        if isinstance(value, int) or isinstance(value, float):
-            queries.update({key: value})
-        else:
-            queries.update({key: '{0}'.format(value)})
+    queries = get_reaction_queries(kwargs)
 
     subtables = []
     if write_db:
@@ -161,15 +298,20 @@ def get_reactions(columns='all', n_results=20, write_db=False, **kwargs):
         subtables = []
     data = query(table='reactions', subtables=subtables,
                  columns=columns,
-                 n_results=n_results, queries=queries)
+                 n_results=n_results, queries=queries,
+                 page_size=page_size)
 
     if not write_db:
         return data
 
     print('Writing result to Reactions.db')
-    unique_ids = []
-    for row in data['reactions']['edges']:
-        with CathubSQLite('Reactions.db') as db:
+    unique_ids = set()
+    new_reactions = []
+    new_keys = set()
+    publications = {}
+    with CathubSQLite('Reactions.db') as db:
+        existing = db.get_check_keys()
+        for row in data['reactions']['edges']:
             row = row['node']
             key_values = {}
             for key in all_columns['reactions']:
@@ -194,44 +336,65 @@ def get_reactions(columns='all', n_results=20, write_db=False, **kwargs):
                 ase_ids = None
                 energy_corrections = None
             else:
-                unique_ids += ase_ids.values()
+                unique_ids.update(ase_ids.values())
             key_values['ase_ids'] = ase_ids
-            key_values['energy_corrections'] = ase_ids
+            key_values['energy_corrections'] = energy_corrections
 
-            # publications
-            pub_key_values = {}
+            # publications, written once per pub_id
             row_p = row['publication']
-            for key in all_columns['publications']:
-                pub_key_values[convert(key)] = row_p[key]
-            db.write_publication(pub_key_values)
+            if row_p['pubId'] not in publications:
+                publications[row_p['pubId']] = \
+                    dict([(convert(key), row_p[key])
+                          for key in all_columns['publications']])
 
             # reactions and reaction_systems
-            id = db.check(key_values['chemical_composition'],
-                          key_values['reaction_energy'])
+            key = (key_values['chemical_composition'],
+                   key_values['reaction_energy'])
+            if key in new_keys:
+                continue
+            id = existing.get(key)
             if id is None:
-                id = db.write(key_values)
+                new_keys.add(key)
+                new_reactions.append(key_values)
             else:
                 db.update(id, key_values)
 
-    if ase_ids is not None:
+        for pub_key_values in publications.values():
+            db.write_publication(pub_key_values)
+        db.write_many(new_reactions)
+
+    if unique_ids:
         # Ase structures
         with ase.db.connect('Reactions.db') as ase_db:
             con = ase_db.connection
             cur = con.cursor()
             cur.execute('SELECT unique_id from systems;')
-            unique_ids0 = cur.fetchall()
-            unique_ids0 = [un[0] for un in unique_ids0]
-            unique_ids = [un for un in unique_ids if un not in unique_ids0]
-            for unique_id in list(set(unique_ids)):
-                # if ase_db.count('unique_id={}'.format(unique_id)) == 0:
-                atomsrow = get_atomsrow_by_id(unique_id)
-                ase_db.write(atomsrow)
+            unique_ids -= set([un[0] for un in cur.fetchall()])
+            rows = get_atomsrows_by_ids(unique_ids)
+            for unique_id in sorted(rows):
+                ase_db.write(rows[unique_id])
 
     print('Writing complete!')
 
     return data
 
 
+def get_reaction_queries(kwargs):
+    """GraphQL arguments for the reactions table from key value strings"""
+    queries = {}
+    for key, value in kwargs.items():
+        key = map_column_names(key)
+        if key == 'distinct':
+            if value in [True, 'True', 'true']:
+                queries.update({key: True})
+                continue
+        if isinstance(value, int) or isinstance(value, float):
+            queries.update({key: value})
+        else:
+            queries.update({key: '{0}'.format(value)})
+    return queries
+
+
 def get_publications(**kwargs):
     queries = {}
     for key, value in kwargs.items():
@@ -267,15 +430,36 @@ def get_logfile(aseId=None, fname=None):
     return data
 
 
-def get_ase_db():
-    server_name = CathubPostgreSQL().server_name
-    return ase.db.connect(server_name)
+def get_atomsrow_by_id(unique_id):
+    """Structure row for unique_id, see get_atomsrows_by_ids"""
+    rows = get_atomsrows_by_ids([unique_id])
+    if unique_id not in rows:
+        raise KeyError('no match')
+    return rows[unique_id]
 
 
-def get_atomsrow_by_id(unique_id):
-    db = get_ase_db()
-    row = db.get('unique_id={}'.format(unique_id))
-    return row
+def get_atomsrows_by_ids(unique_ids, chunksize=1000, workers=1):
+    """
+    Structure rows for many unique_ids, read from the local cache when
+    enabled and otherwise fetched from the server with one query per
+    chunk of unique_ids.
+
+    Returns dict of unique_id: AtomsRow
+    """
+    unique_ids = set(unique_ids)
+    rows = {}
+    if query_cache is not None:
+        rows = query_cache.get_atomsrows(unique_ids)
+    missing = [unique_id for unique_id in unique_ids
+               if unique_id not in rows]
+    if missing:
+        server_name = CathubPostgreSQL().server_name
+        new_rows = get_atoms_rows(server_name, missing,
+                                  chunksize=chunksize, workers=workers)
+        if query_cache is not None:
+            query_cache.set_atomsrows(new_rows.values())
+        rows.update(new_rows)
+    return rows
 
 
 def get_atoms_by_id(unique_id):
@@ -283,6 +467,200 @@ def get_atoms_by_id(unique_id):
     return row.toatoms()
 
 
+# Settings for the shared AsyncClient, see set_async_options
+async_options = {'max_concurrency': 10,
+                 'retries': 3,
+                 'backoff': 0.5}
+
+_async_client = None
+
+
+class AsyncClient:
+    """
+    Concurrent GraphQL queries and structure lookups for asyncio.
+
+    Requests run in threads of the event loop's default executor, at
+    most max_concurrency at a time. Failed requests (connection
+    errors, server errors and rate limits) are retried up to retries
+    times, waiting backoff * 2**attempt seconds in between. Identical
+    requests that are in flight at the same time are coalesced into a
+    single request.
+
+    A client can be used in several event loops, one after the other
+    or in different threads. The limit on concurrent requests applies
+    within each loop.
+
+    Parameters
+    ----------
+    max_concurrency: int
+        maximum number of requests running at the same time
+    retries: int
+        number of retries of a failed request
+    backoff: float
+        wait time before the first retry, in seconds
+    """
+
+    def __init__(self, max_concurrency=10, retries=3, backoff=0.5):
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
+
+    def _loop_state(self):
+        """Semaphore and requests in flight for the running event loop.
+        asyncio primitives belong to the loop they are used in, so they
+        are created again when the client is used in a new loop. Only a
+        weak reference to the loop is kept."""
+        loop = asyncio.get_running_loop()
+        local = self._local
+        if getattr(local, 'loop', None) is None or local.loop() is not loop:
+            local.loop = weakref.ref(loop)
+            local.semaphore = asyncio.Semaphore(self.max_concurrency)
+            local.in_flight = {}
+        return local.semaphore, local.in_flight
+
+    async def execute_graphQL(self, query_string, table=None, url=None):
+        root = url or GRAPHQL_URL
+        key = ('graphql', root, normalize_query(query_string))
+        data = await self._call(key, _fetch_graphQL, root, query_string,
+                                table)
+        # Coalesced callers each get their own copy
+        return copy.deepcopy(data)
+
+    async def get_atomsrow(self, unique_id):
+        return await self._call(('atoms', unique_id), get_atomsrow_by_id,
+                                unique_id)
+
+    async def _call(self, key, func, *args):
+        semaphore, in_flight = self._loop_state()
+        future = in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._retry(semaphore, func, *args))
+            in_flight[key] = future
+            future.add_done_callback(lambda f: in_flight.pop(key, None))
+        # A cancelled caller must not cancel the request for the others
+        return await asyncio.shield(future)
+
+    async def _retry(self, semaphore, func, *args):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore:
+                    return await loop.run_in_executor(None, func, *args)
+            except (requests.RequestException,
+                    psycopg2.OperationalError) as e:
+                if attempt == self.retries or not is_transient(e):
+                    raise
+            await asyncio.sleep(self.backoff * 2**attempt)
+
+
+def is_transient(error):
+    """Whether a failed request is worth retrying: lost or refused
+    connections, timeouts, server errors and rate limits. Errors such
+    as an invalid url or failed authentication are raised at once."""
+    if isinstance(error, requests.HTTPError):
+        if error.response is None:
+            return False
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, psycopg2.OperationalError):
+        if error.pgcode is not None:
+            return error.pgcode[:2] == '08' or \
+                error.pgcode in transient_pgcodes
+        message = str(error).lower()
+        return any(text in message for text in transient_pg_messages)
+    return False
+
+
+# Postgres errors that go away when the connection is made again:
+# admin and crash shutdown, cannot connect now and too many connections
+transient_pgcodes = ['57P01', '57P02', '57P03', '53300']
+
+# Messages of psycopg2 errors without pgcode for lost connections
+transient_pg_messages = ['server closed the connection unexpectedly',
+                         'could not connect to server',
+                         'connection refused',
+                         'timeout expired',
+                         'ssl syscall error',
+                         'terminating connection',
+                         'connection already closed']
+
+
+def _fetch_graphQL(root, query_string, table):
+    data = None
+    if query_cache is not None:
+        data = query_cache.get_response(root, query_string)
+    if data is None:
+        response = get_session().post(root, {'query': query_string})
+        response.raise_for_status()
+        data = response.json()['data']
+        if query_cache is not None and data is not None:
+            query_cache.set_response(root, query_string, data)
+    if not table == 'logs':
+        load_nested(data, table)
+    return data
+
+
+def get_async_client():
+    """AsyncClient shared by all requests without a client argument"""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncClient(**async_options)
+    return _async_client
+
+
+def set_async_options(**kwargs):
+    """
+    Change max_concurrency, retries or backoff of the AsyncClient used
+    by aget_reactions and aget_atoms without a client argument.
+    """
+    global _async_client
+    async_options.update(kwargs)
+    _async_client = None
+
+
+async def aget_reactions(columns='all', n_results=20, url=None,
+                         client=None, **kwargs):
+    """
+    Get reactions from server, as get_reactions, for use with asyncio.
+    Calls made concurrently share the limits of the AsyncClient.
+
+    Give key value strings as arguments
+    """
+    if columns == 'all':
+        columns = all_columns['reactions']
+    query_string = graphql_query(table='reactions',
+                                 columns=columns,
+                                 n_results=n_results,
+                                 queries=get_reaction_queries(kwargs))
+    client = client or get_async_client()
+    return await client.execute_graphQL(query_string, table='reactions',
+                                        url=url)
+
+
+async def aget_atoms(unique_id, client=None):
+    """Atoms for unique_id, as get_atoms_by_id, for use with asyncio"""
+    client = client or get_async_client()
+    row = await client.get_atomsrow(unique_id)
+    return row.toatoms()
+
+
+def run_async(awaitables):
+    """
+    Run awaitables, such as aget_reactions() and aget_atoms() calls,
+    concurrently from synchronous code.
+
+    Returns list of results in the same order
+    """
+    async def gather():
+        return await asyncio.gather(*awaitables)
+
+    return asyncio.run(gather())
+
+
 def map_column_names(column):
     mapping = {'surface': 'chemicalComposition'}
 
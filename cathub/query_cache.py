@@ -0,0 +1,197 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from ase.db.row import AtomsRow
+from ase.io.jsonio import encode, decode
+
+CACHE_FILENAME = os.path.join(os.path.expanduser('~'), '.cathub',
+                              'query_cache.db')
+
+init_command = """CREATE TABLE IF NOT EXISTS entry (
+    key text PRIMARY KEY,
+    kind text,
+    created real,
+    accessed real,
+    size integer,
+    data text
+    );"""
+
+index_command = """CREATE INDEX IF NOT EXISTS entry_accessed
+    ON entry (accessed);"""
+
+# Limit on the number of ? parameters in one SQLite statement
+max_variables = 900
+
+
+def normalize_query(query_string):
+    """Query string with whitespace collapsed, used as cache key"""
+    query_string = re.sub(r'\s+', ' ', query_string).strip()
+    return re.sub(r'\s*([{}(),:])\s*', r'\1', query_string)
+
+
+def row_to_dict(row):
+    dct = {key: value for key, value in row.__dict__.items()
+           if key not in row._keys and
+           key not in ['_keys', '_data', '_constrained_forces']}
+    dct['key_value_pairs'] = row.key_value_pairs
+    dct['data'] = row.data
+    return dct
+
+
+class QueryCache:
+    """
+    Local cache of server responses, kept in an SQLite file.
+
+    GraphQL responses are stored under their normalized query string
+    and expire after ttl seconds. Structure rows are stored under
+    their unique_id, which never changes, and do not expire. When the
+    cache grows beyond max_size bytes, the least recently used
+    entries are removed.
+
+    Parameters
+    ----------
+    filename: str
+        SQLite file for the cache, default ~/.cathub/query_cache.db
+    ttl: float
+        lifetime of GraphQL responses in seconds
+    max_size: int
+        maximum total size of the cached data in bytes
+    """
+
+    def __init__(self, filename=None, ttl=24 * 3600, max_size=500 * 1024**2):
+        self.filename = filename or CACHE_FILENAME
+        self.ttl = ttl
+        self.max_size = max_size
+        self._con = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Connection of this cache, opened on first use. It is shared
+        by the threads of prefetching and async queries, which take
+        turns through self._lock"""
+        if self._con is None:
+            dirname = os.path.dirname(os.path.abspath(self.filename))
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            con = sqlite3.connect(self.filename, timeout=600,
+                                  check_same_thread=False)
+            con.execute(init_command)
+            con.execute(index_command)
+            cur = con.execute('SELECT sum(size) FROM entry')
+            self._size = cur.fetchone()[0] or 0
+            con.commit()
+            self._con = con
+        return self._con
+
+    def close(self):
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+    def get_many(self, keys, ttl=None):
+        """Cached values for keys, as a dict with the keys found.
+        Entries older than ttl seconds are removed instead."""
+        keys = list(keys)
+        now = time.time()
+        found = {}
+        with self._lock:
+            con = self._connect()
+            cur = con.cursor()
+            for i in range(0, len(keys), max_variables):
+                chunk = keys[i:i + max_variables]
+                cur.execute(
+                    'SELECT key, created, size, data FROM entry '
+                    'WHERE key IN ({})'.format(', '.join('?' * len(chunk))),
+                    chunk)
+                for key, created, size, data in cur.fetchall():
+                    if ttl is not None and now - created > ttl:
+                        cur.execute('DELETE FROM entry WHERE key=?', [key])
+                        self._size -= size
+                    else:
+                        found[key] = data
+            cur.executemany('UPDATE entry SET accessed=? WHERE key=?',
+                            [[now, key] for key in found])
+            con.commit()
+        return {key: decode(data) for key, data in found.items()}
+
+    def set_many(self, entries):
+        """Store (key, kind, value) entries in one transaction"""
+        now = time.time()
+        rows = {}
+        for key, kind, value in entries:
+            data = encode(value)
+            rows[key] = [key, kind, now, now, len(data), data]
+        if not rows:
+            return
+        keys = list(rows)
+        with self._lock:
+            con = self._connect()
+            cur = con.cursor()
+            for i in range(0, len(keys), max_variables):
+                chunk = keys[i:i + max_variables]
+                cur.execute(
+                    'SELECT sum(size) FROM entry '
+                    'WHERE key IN ({})'.format(', '.join('?' * len(chunk))),
+                    chunk)
+                self._size -= cur.fetchone()[0] or 0
+            cur.executemany('INSERT OR REPLACE INTO entry '
+                            '(key, kind, created, accessed, size, data) '
+                            'VALUES (?, ?, ?, ?, ?, ?)', list(rows.values()))
+            self._size += sum(row[4] for row in rows.values())
+            self._evict(cur)
+            con.commit()
+
+    def _evict(self, cur):
+        excess = self._size - self.max_size
+        if excess <= 0:
+            return
+        cur.execute('SELECT key, size FROM entry ORDER BY accessed')
+        keys = []
+        for key, size in cur:
+            if excess <= 0:
+                break
+            keys.append(key)
+            excess -= size
+            self._size -= size
+        cur.executemany('DELETE FROM entry WHERE key=?',
+                        [[key] for key in keys])
+
+    def get_response(self, url, query_string):
+        """Cached GraphQL data for query, or None"""
+        key = 'graphql:{}:{}'.format(url, normalize_query(query_string))
+        return self.get_many([key], ttl=self.ttl).get(key)
+
+    def set_response(self, url, query_string, data):
+        key = 'graphql:{}:{}'.format(url, normalize_query(query_string))
+        self.set_many([(key, 'graphql', data)])
+
+    def get_atomsrow(self, unique_id):
+        """Cached ase.db row for unique_id, or None"""
+        return self.get_atomsrows([unique_id]).get(unique_id)
+
+    def set_atomsrow(self, row):
+        self.set_atomsrows([row])
+
+    def get_atomsrows(self, unique_ids):
+        """Cached ase.db rows, as a dict of unique_id: AtomsRow for the
+        unique_ids found"""
+        found = self.get_many('atoms:{}'.format(unique_id)
+                              for unique_id in unique_ids)
+        return {key[len('atoms:'):]: AtomsRow(dct)
+                for key, dct in found.items()}
+
+    def set_atomsrows(self, rows):
+        self.set_many(('atoms:{}'.format(row.unique_id), 'atoms',
+                       row_to_dict(row)) for row in rows)
+
+    def clear(self):
+        """Remove all cached entries"""
+        with self._lock:
+            con = self._connect()
+            con.execute('DELETE FROM entry')
+            con.commit()
+            self._size = 0
@@ -0,0 +1,61 @@
+import os
+import unittest
+import numpy as np
+import ase.io
+from cathub.ase_tools import read_outcar_final, read_params_xml
+
+path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'vasp'))
+
+# read_params_xml of vasp/vasprun.xml as returned by the full parser
+# used before read_kpoints was added
+vasprun_parameters = {
+    'kpoints': {'kpointlist': [[0.0, 0.0, 0.0], [0.25, 0.0, 0.0]],
+                'weights': ['0.0625', '0.1250'],
+                'generation': {'divisions': [4, 4, 1],
+                               'usershift': [0.0, 0.0, 0.0]}},
+    'generator': {'program': 'vasp', 'version': '5.4.4'},
+    'incar': {'PREC': 'accurate', 'ENCUT': 400.0, 'ISPIN': 2,
+              'LDAUL': [2, -1]},
+    'psp_info': [{'atomspertype': '2', 'element': 'Pt',
+                  'mass': '195.08000000', 'valence': '10.00000000',
+                  'pseudopotential': 'PAW_PBE Pt 04Feb2005'},
+                 {'atomspertype': '1', 'element': 'O',
+                  'mass': '16.00000000', 'valence': '6.00000000',
+                  'pseudopotential': 'PAW_PBE O 08Apr2002'}]}
+
+
+class ASEToolsTestCase(unittest.TestCase):
+    def test_read_outcar_final(self):
+        # the truncated file ends inside the energies of the last step,
+        # which is then skipped
+        for filename in ['OUTCAR', 'OUTCAR_truncated']:
+            filename = os.path.join(path, filename)
+            atoms = read_outcar_final(filename)
+            reference = ase.io.read(filename, -1)
+            assert atoms.get_chemical_symbols() == \
+                reference.get_chemical_symbols()
+            assert atoms.get_potential_energy() == \
+                reference.get_potential_energy()
+            assert np.allclose(atoms.get_forces(), reference.get_forces())
+            assert np.allclose(atoms.positions, reference.positions)
+            assert np.allclose(atoms.cell, reference.cell)
+        assert read_outcar_final(os.path.join(path, 'OUTCAR')) \
+            .get_potential_energy() == -13.2
+        assert read_outcar_final(os.path.join(path, 'OUTCAR_truncated')) \
+            .get_potential_energy() == -12.2
+
+    def test_read_params_xml(self):
+        # the calculation part of the file is broken off, which is
+        # fine as long as it is never parsed
+        filename = os.path.join(path, 'vasprun.xml')
+        assert read_params_xml(filename, read_kpoints=True) == \
+            vasprun_parameters
+        parameters = read_params_xml(filename)
+        assert parameters['kpoints'] == \
+            {'generation': vasprun_parameters['kpoints']['generation']}
+        for key in ['generator', 'incar', 'psp_info']:
+            assert parameters[key] == vasprun_parameters[key]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@ import os
 import sys
 import unittest
 import tempfile
+import shutil
 import pprint
 import sqlite3
 import json
@@ -45,6 +46,23 @@ class CommandLineTestCase(unittest.TestCase):
         runner = CliRunner()
         runner.invoke(folder2db, ['aayush/'])
 
+    def test_cli_collect_cache(self):
+        from cathub.cli import collect
+        runner = CliRunner()
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = os.path.join(tmp, 'gas')
+            shutil.copytree('aayush/montoya_the_2015/Quantum ESPRESSO/'
+                            'BEEF-vdW/gas', folder)
+            out_db = os.path.join(tmp, 'out.db')
+            result = runner.invoke(collect, [folder, '-fe', '.traj',
+                                             '-o', out_db])
+            assert result.exit_code == 0
+            assert not os.path.exists(os.path.join(folder, '.cathub_cache.db'))
+            result = runner.invoke(collect, [folder, '-fe', '.traj',
+                                             '-o', out_db, '--clear-cache'])
+            assert result.exit_code == 0
+            assert os.path.exists(os.path.join(folder, '.cathub_cache.db'))
+
     def test2_cli_db2server(self):
         from cathub.postgresql import CathubPostgreSQL
         from cathub.cli import db2server
@@ -0,0 +1,228 @@
+import os
+import unittest
+import numpy as np
+import ase.io
+import ase.build
+from ase.constraints import FixAtoms
+from ase.geometry import get_distances
+from ase.calculators.singlepoint import SinglePointCalculator
+from cathub import organize
+from cathub.ase_tools import collect_structures
+
+path = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                    'unorganized'))
+
+
+class Struct:
+    def __init__(self, **entries):
+        self.__dict__.update(entries)
+
+
+def pairwise_displaced_atoms(surf_ads, surf_empty, tolerance):
+    """Displaced atoms as found by the pairwise loop of fuzzy_match
+    before the pre-pass"""
+    distances, distances_abs = get_distances(
+        surf_ads.get_positions(), surf_empty.get_positions(),
+        cell=surf_ads.cell, pbc=True)
+    return np.where(np.min(distances_abs, axis=1) > tolerance)[0]
+
+
+def pairwise_constraint_flag(surf_empty, surf_ads):
+    """Constraint check of the pairwise loop of fuzzy_match before the
+    pre-pass"""
+    constraints_empty = [c.todict()['kwargs']['indices']
+                         for c in surf_empty.constraints
+                         if c.todict()['name'] == 'FixAtoms']
+    constraints_ads = [c.todict()['kwargs']['indices']
+                       for c in surf_ads.constraints
+                       if c.todict()['name'] == 'FixAtoms']
+    if not constraints_empty:
+        return 0
+    for atoms, indices, other in [
+            (surf_empty, constraints_empty[0], surf_ads),
+            (surf_ads, constraints_ads[0], surf_empty)]:
+        for cp in atoms[indices].positions:
+            if not np.any(np.all(np.isclose(cp, other.positions,
+                                            atol=1e-4), axis=1)):
+                return 1
+    return 0
+
+
+def constraint_flag(surf_empty, surf_ads):
+    """Constraint check of the pre-pass of fuzzy_match"""
+    fixed_positions = [organize.get_fixed_positions(surf_empty),
+                       organize.get_fixed_positions(surf_ads)]
+    if fixed_positions[0] is None:
+        return 0
+    if fixed_positions[1] is None:
+        return 1
+    fixed_keys = [organize.get_position_keys(p) for p in fixed_positions]
+    position_keys = [set(organize.get_position_keys(s.positions))
+                     for s in [surf_empty, surf_ads]]
+    return int(not (
+        organize.positions_match(fixed_positions[0], fixed_keys[0],
+                                 surf_ads, position_keys[1]) and
+        organize.positions_match(fixed_positions[1], fixed_keys[1],
+                                 surf_empty, position_keys[0])))
+
+
+def pairwise_volume_groups(volumes, tolerance):
+    """Volume groups of fuzzy_match before the sort-and-sweep, which
+    compared each volume to the first volume of all groups"""
+    volume_groups = {}
+    for n in sorted(range(len(volumes)), key=lambda n: volumes[n]):
+        for volume in volume_groups:
+            if abs(volume - volumes[n]) < tolerance:
+                volume_groups[volume].append(n)
+                break
+        else:
+            volume_groups[volumes[n]] = [n]
+    return volume_groups
+
+
+def get_wrapped_slab(surf_ads, energy):
+    """Copy of surf_ads with the adsorbate and the top layer moved
+    across the periodic boundaries of the cell"""
+    wrapped = surf_ads.copy()
+    wrapped.positions[-1] -= wrapped.cell[0]
+    wrapped.positions[12:16] += wrapped.cell[1]
+    wrapped.calc = SinglePointCalculator(wrapped, energy=energy)
+    wrapped.info = dict(surf_ads.info,
+                        filename=surf_ads.info['filename']
+                        .replace('.traj', '_wrapped.traj'))
+    return wrapped
+
+
+class OrganizeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.surf_empty = ase.io.read(
+            os.path.join(path, 'empty_slab_111.traj'))
+        self.surf_ads = ase.io.read(
+            os.path.join(path, 'empty_slab_111_ads.traj'))
+        self.surf_ads.info['filename'] = 'empty_slab_111_ads.traj'
+
+    def test_get_displaced_atoms(self):
+        wrapped = get_wrapped_slab(self.surf_ads, energy=509)
+        rattled = self.surf_ads.copy()
+        rattled.rattle(stdev=0.5, seed=1)
+        # a surface with another cell is compared in its own cell
+        larger = ase.build.fcc111('Pt', [3, 3, 4], vacuum=10)
+        ase.build.add_adsorbate(larger, 'O', height=1.5)
+        surfaces = [self.surf_ads, wrapped, larger, self.surf_empty,
+                    rattled]
+        # the adsorbate is 1.5 Angstrom above the nearest Pt atom
+        for tolerance in [0.1, 1, 1.5, 2, 3]:
+            reference = [pairwise_displaced_atoms(surf_ads, self.surf_empty,
+                                                  tolerance)
+                         for surf_ads in surfaces]
+            for max_pairs in [100000, 50]:
+                displaced = organize.get_displaced_atoms(
+                    surfaces, self.surf_empty, tolerance,
+                    max_pairs=max_pairs)
+                for idx, reference_idx in zip(displaced, reference):
+                    assert idx.tolist() == reference_idx.tolist()
+        displaced = organize.get_displaced_atoms(
+            [self.surf_ads, wrapped], self.surf_empty, 1)
+        assert [idx.tolist() for idx in displaced] == [[16], [16]]
+
+    def test_positions_match(self):
+        self.surf_empty.set_constraint(FixAtoms(indices=range(8)))
+        surfaces = []
+        for indices, shift in [(range(8, 16), [0, 0, 0.5]),
+                               (range(16), [0.5e-4, 0, 0]),
+                               (range(16), [0.4e-4, 0.4e-4, -0.4e-4]),
+                               ([0], [1.5e-4, 0, 0]),
+                               ([7], [0, 0, -1])]:
+            surf_ads = self.surf_ads.copy()
+            surf_ads.positions[indices] += shift
+            surfaces.append(surf_ads)
+        surfaces.append(get_wrapped_slab(self.surf_ads, energy=509))
+        surf_ads = self.surf_ads.copy()
+        surf_ads.positions[:4] += surf_ads.cell[1]
+        surfaces.append(surf_ads)
+        flags = []
+        for surf_ads in surfaces:
+            surf_ads.set_constraint(FixAtoms(indices=range(8)))
+            for surf_empty, other in [(self.surf_empty, surf_ads),
+                                      (surf_ads, self.surf_empty)]:
+                flags.append(constraint_flag(surf_empty, other))
+                assert flags[-1] == pairwise_constraint_flag(surf_empty,
+                                                             other)
+        assert flags == [0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 0, 0, 1, 1]
+
+    def test_group_by_volume(self):
+        # near-duplicate slabs with volumes close to the tolerance from
+        # each other
+        area = self.surf_empty.get_volume() / self.surf_empty.cell[2, 2]
+        slabs = []
+        for delta in [1.5e-5, 0, 2.02e-5, 0.99e-5, 2e-5, 1.01e-5, 5e-5,
+                      2.02e-5]:
+            slab = self.surf_empty.copy()
+            slab.cell[2, 2] += delta / area
+            slabs.append(slab)
+        volumes = [slab.get_volume() for slab in slabs]
+        tolerance = 1e-5
+        volume_groups = organize.group_by_volume(volumes, tolerance)
+        assert volume_groups == pairwise_volume_groups(volumes, tolerance)
+        # 1.5e-5 is within tolerance of 0.99e-5, but that is not the
+        # first volume of its group
+        assert list(volume_groups.values()) == \
+            [[1, 3], [5, 0, 4], [2, 7], [6]]
+
+        volumes = np.random.RandomState(1).normal(700, 1e-4, 200)
+        for tolerance in [1e-6, 1e-5, 1e-4]:
+            assert organize.group_by_volume(volumes, tolerance) == \
+                pairwise_volume_groups(volumes, tolerance)
+
+    def test_fuzzy_match(self):
+        options = Struct(**{
+            'adsorbates': ['O', 'H2'],
+            'verbose': False,
+            'dft_code': '',
+            'xc_functional': '',
+            'facet_name': '111',
+            'max_density_gas': 0.002,
+            'max_density_slab': 0.06,
+            'exclude_reference': '',
+            'max_energy': 10,
+            'keep_all_energies': True,
+            'keep_all_slabs': True,
+            'reorganization_tol': 1,
+            'interactive': False,
+            'high_coverage': False,
+            'energy_corrections': {},
+            'skip_parameters': '',
+            'skip_constraints': '',
+        })
+        structures = list(collect_structures(path,
+                                             file_extensions=['traj']))
+        surf_ads, = [s for s in structures
+                     if s.info['filename'].endswith('_ads.traj')]
+        wrapped = get_wrapped_slab(surf_ads, energy=509)
+        # differs in a fixed atom from the empty slab
+        moved = wrapped.copy()
+        moved.positions[0] += 0.01
+        moved.calc = SinglePointCalculator(moved, energy=508)
+        moved.info = dict(wrapped.info, filename='moved.traj')
+        structures += [wrapped, moved]
+        for structure in structures:
+            if len(structure) > 10:
+                structure.set_constraint(FixAtoms(indices=range(8)))
+
+        # Pairs found by the pairwise loop before the pre-pass
+        collected = organize.fuzzy_match(structures, options)
+        slabs = collected['traj']['']['Pt16_Epot=500']['111']
+        assert os.path.basename(slabs['empty_slab'].info['filename']) == \
+            'empty_slab_111.traj'
+        assert sorted(slabs) == ['Ogas_star__O@site1',
+                                 'Ogas_star__O@site2', 'empty_slab']
+        for equation, filename in [
+                ('Ogas_star__O@site1', 'empty_slab_111_ads_wrapped.traj'),
+                ('Ogas_star__O@site2', 'empty_slab_111_ads.traj')]:
+            atoms = slabs[equation]['O']
+            assert os.path.basename(atoms.info['filename']) == filename
+            assert np.where(atoms.get_tags())[0].tolist() == [16]
+
+
+if __name__ == '__main__':
+    unittest.main()
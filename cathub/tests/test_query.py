@@ -0,0 +1,179 @@
+import os
+import re
+import json
+import base64
+import tempfile
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+import requests
+import psycopg2
+from ase.build import molecule
+from ase.db.row import AtomsRow
+from ase.calculators.singlepoint import SinglePointCalculator
+from cathub import query
+from cathub.query_cache import QueryCache
+
+reactions = [{'chemicalComposition': 'Pt16',
+              'reactionEnergy': -0.1 * i,
+              'reactants': json.dumps({'Hstar': 1.0})}
+             for i in range(25)]
+
+
+class GraphQLHandler(BaseHTTPRequestHandler):
+    """Stand-in for the reactions table of the GraphQL server"""
+    requests = []
+    failures = 0
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        query_string = parse_qs(self.rfile.read(length).decode())['query'][0]
+        self.requests.append(query_string)
+        if GraphQLHandler.failures > 0:
+            GraphQLHandler.failures -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        first = int(re.search(r'first: (\d+)', query_string).group(1))
+        after = re.search(r'after: "(.*?)"', query_string)
+        start = 0
+        if after:
+            start = int(base64.b64decode(after.group(1))) + 1
+        nodes = reactions[start:start + first]
+        end = start + len(nodes) - 1
+        data = {'reactions': {
+            'totalCount': len(reactions),
+            'pageInfo': {'hasNextPage': end + 1 < len(reactions),
+                         'endCursor': base64.b64encode(
+                             str(end).encode()).decode()},
+            'edges': [{'node': dict(node)} for node in nodes]}}
+        body = json.dumps({'data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class QueryTestCase(unittest.TestCase):
+    def setUp(self):
+        # other tests may have turned on the default cache
+        query.set_cache(False)
+        GraphQLHandler.requests = []
+        GraphQLHandler.failures = 0
+        self.server = HTTPServer(('127.0.0.1', 0), GraphQLHandler)
+        self.url = 'http://127.0.0.1:{}/graphql'.format(
+            self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_iter_nodes(self):
+        columns = ['chemicalComposition', 'reactionEnergy', 'reactants']
+        for prefetch in [True, False]:
+            GraphQLHandler.requests = []
+            nodes = list(query.iter_nodes(columns=columns, page_size=10,
+                                          prefetch=prefetch, url=self.url))
+            assert [node['reactionEnergy'] for node in nodes] == \
+                [reaction['reactionEnergy'] for reaction in reactions]
+            assert nodes[0]['reactants'] == {'Hstar': 1.0}
+            assert len(GraphQLHandler.requests) == 3
+            assert 'after' not in GraphQLHandler.requests[0]
+            assert 'totalCount' not in GraphQLHandler.requests[1]
+
+        nodes = list(query.iter_nodes(columns=columns, n_results=12,
+                                      page_size=10, url=self.url))
+        assert len(nodes) == 12
+        assert 'first: 2' in GraphQLHandler.requests[-1]
+
+        data = query.query(columns=columns, n_results=15, page_size=10,
+                           url=self.url)
+        assert len(data['reactions']['edges']) == 15
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'cache.db')
+            query.set_cache(filename=filename)
+            try:
+                for i in range(2):
+                    data = query.query(columns=['reactionEnergy'],
+                                       n_results=5, url=self.url)
+                    assert len(data['reactions']['edges']) == 5
+                assert len(GraphQLHandler.requests) == 1
+            finally:
+                query.set_cache(False)
+
+            atoms = molecule('H2O')
+            atoms.calc = SinglePointCalculator(atoms, energy=-1.0)
+            row = AtomsRow(atoms)
+            row.unique_id = 'abc'
+            cache = QueryCache(filename, max_size=10**4)
+            cache.set_atomsrow(row)
+            cached = cache.get_atomsrow('abc')
+            assert cached.energy == -1.0
+            assert cached.toatoms().get_chemical_formula() == 'H2O'
+            rows = []
+            for unique_id in ['def', 'ghi']:
+                rows.append(AtomsRow(atoms))
+                rows[-1].unique_id = unique_id
+            cache.set_atomsrows(rows)
+            cached = cache.get_atomsrows(['abc', 'def', 'ghi', 'xyz'])
+            assert sorted(cached) == ['abc', 'def', 'ghi']
+            cache.set_response(self.url, '{ x }', {'x': 'y' * 10**4})
+            assert cache.get_atomsrow('abc') is None
+            cur = cache._connect().execute('SELECT sum(size) FROM entry')
+            assert cache._size == (cur.fetchone()[0] or 0)
+            cache.close()
+
+    def test_async(self):
+        client = query.AsyncClient(max_concurrency=2, backoff=0.01)
+        GraphQLHandler.failures = 1
+        results = query.run_async(
+            [query.aget_reactions(columns=['reactionEnergy'], n_results=n,
+                                  url=self.url, client=client)
+             for n in [3, 3, 3, 5]])
+        assert [len(data['reactions']['edges']) for data in results] == \
+            [3, 3, 3, 5]
+        # identical queries are coalesced, the first failure is retried
+        assert len(GraphQLHandler.requests) == 3
+        assert results[0] == results[1] and results[0] is not results[1]
+
+        # the same client in a new event loop
+        GraphQLHandler.requests = []
+        results = query.run_async(
+            [query.aget_reactions(columns=['reactionEnergy'], n_results=n,
+                                  url=self.url, client=client)
+             for n in range(1, 7)])
+        assert [len(data['reactions']['edges']) for data in results] == \
+            list(range(1, 7))
+        assert len(GraphQLHandler.requests) == 6
+
+    def test_is_transient(self):
+        response = requests.Response()
+        for status, transient in [(503, True), (429, True), (404, False)]:
+            response.status_code = status
+            assert query.is_transient(
+                requests.HTTPError(response=response)) == transient
+        assert query.is_transient(requests.ConnectionError())
+        assert query.is_transient(requests.Timeout())
+        assert not query.is_transient(requests.exceptions.InvalidURL())
+        assert not query.is_transient(requests.exceptions.MissingSchema())
+        assert query.is_transient(psycopg2.OperationalError(
+            'server closed the connection unexpectedly'))
+        assert not query.is_transient(psycopg2.OperationalError(
+            'FATAL:  password authentication failed for user "x"'))
+        assert not query.is_transient(psycopg2.OperationalError(
+            'FATAL:  database "x" does not exist'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,18 @@
+import io
 import os
 import json
 import unittest
 import shutil
+import ase.db
+from concurrent.futures import ProcessPoolExecutor
 from cathub.postgresql import CathubPostgreSQL
-from cathub.cathubsqlite import CathubSQLite
-from cathub.cathubsql import CathubSQL
+from cathub.cathubsqlite import CathubSQLite, get_reaction_fingerprint
+from cathub.cathubsql import CathubSQL, get_atoms_rows
 from cathub.query import get_reactions
 from cathub import db2server, make_folders_template, folder2db
+from cathub.folderreader import FolderReader
+from cathub.ase_tools import collect_structures
+from cathub.ase_tools.parse_cache import ParseCache
 
 path = os.path.abspath(os.path.join(os.path.dirname(__file__)))
 
@@ -88,6 +94,28 @@ class UploadTestCase(unittest.TestCase):
     def test1_read_folders(self):
         folder2db.main('{path}/aayush/'.format(path=path))
 
+    def test2_write_batch_errors(self):
+        shutil.copytree('{path}/aayush/montoya_the_2015'.format(path=path),
+                        'temp/montoya_the_2015')
+
+        class BadReactionReader(FolderReader):
+            def read(self, **kwargs):
+                for i, key_values in enumerate(
+                        FolderReader.read(self, **kwargs)):
+                    if i == 3:
+                        self.bad_root = self.root
+                        key_values['sites'] = {'N': {'ontop'}}  # not json
+                    yield key_values
+
+        reader = BadReactionReader('temp/montoya_the_2015', debug=True,
+                                   stdout=io.StringIO())
+        reader.write(batch_size=10)
+        with CathubSQLite(reader.cathub_db) as db:
+            assert db.get_last_id(db.connection.cursor()) == 23
+        errors = [warning for warning in reader.warnings
+                  if 'Writing error' in warning]
+        assert len(errors) == 1 and reader.bad_root in errors[0]
+
     def test2_api(self):
         filename = '{path}/aayush/MontoyaChallenge2015.db'.format(path=path)
         db = CathubSQL(filename=filename)
@@ -101,6 +129,174 @@ class UploadTestCase(unittest.TestCase):
         assert 1.1360665501670155 in data_dict['reaction_energy'].values()
         assert 'Pt16' in data_dict['chemical_composition'].values()
 
+        energies = db.get_dataframe(columns=['reaction_energy'])
+        assert energies.shape == (24, 2)
+        chunks = list(db.get_dataframe(columns=['atoms_id', 'equation'],
+                                       chunksize=10))
+        assert [len(chunk) for chunk in chunks] == [10, 10, 4]
+        assert chunks[0]['atoms_id'][0] == data_dict['atoms_id'][0]
+        assert len(db.get_dataframe(elements=['Pt'], facet='111')) == 24
+        assert len(db.get_dataframe(elements=['P'])) == 0
+
+    def test2_get_atoms_rows(self):
+        filename = '{path}/aayush/MontoyaChallenge2015.db'.format(path=path)
+        with ase.db.connect(filename) as ase_db:
+            rows = list(ase_db.select())
+        unique_ids = [row.unique_id for row in rows] + ['missing']
+        for workers in [1, 2]:
+            id_to_row = get_atoms_rows(filename, unique_ids, chunksize=5,
+                                       workers=workers)
+            assert len(id_to_row) == len(rows)
+            for row in rows:
+                fetched = id_to_row[row.unique_id]
+                assert fetched.id == row.id
+                assert fetched.energy == row.energy
+                assert (fetched.positions == row.positions).all()
+                assert (fetched.forces == row.forces).all()
+                assert fetched.key_value_pairs == row.key_value_pairs
+                assert fetched.data == row.data
+                assert fetched.calculator_parameters == \
+                    row.calculator_parameters
+
+    def test2_write_many(self):
+        values = {'chemical_composition': 'Pt16',
+                  'surface_composition': 'Pt',
+                  'facet': '111',
+                  'sites': {'Hstar': 'fcc'},
+                  'coverages': {},
+                  'reactants': {'H2gas': 0.5, 'star': 1.0},
+                  'products': {'Hstar': 1.0},
+                  'activation_energy': None,
+                  'dft_code': 'Quantum ESPRESSO',
+                  'dft_functional': 'BEEF-vdW',
+                  'username': 'test',
+                  'pub_id': 'TestWrite2021',
+                  'energy_corrections': {}}
+        reactions = []
+        for i in range(5):
+            reaction = values.copy()
+            reaction['reaction_energy'] = -0.1 * i
+            reaction['ase_ids'] = {'Hstar': 'ads{}'.format(i),
+                                   'star': 'slab'}
+            reactions.append(reaction)
+
+        with CathubSQLite('temp/write_many.db') as db:
+            id0 = db.write(reactions[0])
+            ids = db.write_many(iter(reactions[1:]), batch_size=2)
+            assert ids == [id0 + 1, id0 + 2, id0 + 3, id0 + 4]
+            cur = db.connection.cursor()
+            for id, reaction in zip(ids, reactions[1:]):
+                assert db.check('Pt16', reaction['reaction_energy']) == id
+                cur.execute('SELECT ase_id FROM reaction_system WHERE id=?',
+                            [id])
+                assert sorted(cur.fetchall()) == \
+                    sorted([(a,) for a in reaction['ase_ids'].values()])
+            cur.execute('SELECT count(*) FROM publication_system')
+            assert cur.fetchone()[0] == 6
+
+    def test2_migrate_schema(self):
+        shutil.copy('{path}/io/PengRole2020.db'.format(path=path),
+                    'temp/migrate.db')
+        with CathubSQLite('temp/migrate.db') as db:
+            assert db.check('Pt16', 0) is None
+            cur = db.connection.cursor()
+            cur.execute("""SELECT id, chemical_composition, facet, sites,
+            reactants, products, reaction_energy, fingerprint
+            FROM reaction""")
+            rows = cur.fetchall()
+            assert len(rows) > 0
+            for row in rows:
+                assert row[7] is not None
+            id, composition, facet, sites, reactants, products, energy, \
+                fingerprint = rows[-1]
+            assert db.check(composition, energy) is not None
+            assert get_reaction_fingerprint(
+                {'chemical_composition': composition, 'facet': facet,
+                 'sites': sites, 'reactants': json.loads(reactants),
+                 'products': products,
+                 'reaction_energy': energy + 1e-7}) == fingerprint
+            cur.execute("""SELECT name FROM sqlite_master
+            WHERE type='index' AND name='idxchemcomp'""")
+            assert cur.fetchone() is not None
+            cur.execute("""SELECT count(*) FROM systems WHERE id NOT IN
+            (SELECT id FROM text_key_values
+            WHERE key='structure_fingerprint')""")
+            assert cur.fetchone()[0] == 0
+
+    def test2_compress_logs(self):
+        shutil.copy('{path}/io/PengRole2020.db'.format(path=path),
+                    'temp/logs.db')
+        blob = b'OUTCAR ' * 1000
+        with CathubSQLite('temp/logs.db') as db:
+            cur = db.connection.cursor()
+            cur.execute('SELECT id, unique_id FROM systems LIMIT 2')
+            (id, ase_id), (id2, ase_id2) = cur.fetchall()
+            db.write_log(ase_id, 'OUTCAR', blob, codec=None)
+            db.write_log(ase_id2, 'OUTCAR', blob, codec=None)
+            db.compress_logs(codec='zlib')
+            cur.execute('SELECT codec, length(logfile) FROM log_blob')
+            rows = cur.fetchall()
+            assert len(rows) == 1
+            codec, size = rows[0]
+            assert codec == 'zlib' and size < len(blob)
+            assert db.read_log(id) == [(ase_id, 'OUTCAR', blob)]
+            assert db.read_log(id2) == [(ase_id2, 'OUTCAR', blob)]
+
+    def test2_parse_cache(self):
+        folder = '{path}/aayush'.format(path=path)
+        structures = list(collect_structures(folder, cache='temp/cache.db'))
+        cached = list(collect_structures(folder, cache='temp/cache.db'))
+        assert len(cached) == len(structures) > 0
+        for atoms, atoms_cached in zip(structures, cached):
+            assert atoms.info == atoms_cached.info
+            assert atoms.get_potential_energy() == \
+                atoms_cached.get_potential_energy()
+            assert atoms.calc.parameters == atoms_cached.calc.parameters
+        structures = list(collect_structures(folder, cache='temp/cache.db',
+                                             clear_cache=True, workers=2))
+        assert [atoms.info for atoms in structures] == \
+            [atoms.info for atoms in cached]
+        # a changed vasprun.xml next to a file invalidates its entry
+        os.makedirs('temp/sibling', exist_ok=True)
+        shutil.copy('{folder}/montoya_the_2015/Quantum ESPRESSO/BEEF-vdW/'
+                    'gas/H2_gas.traj'.format(folder=folder), 'temp/sibling')
+        cache = ParseCache('temp/cache.db')
+        cache.set('temp/sibling/H2_gas.traj', [], [])
+        assert cache.get('temp/sibling/H2_gas.traj') == ([], [])
+        with open('temp/sibling/vasprun.xml', 'w') as f:
+            f.write('<modeling/>')
+        assert cache.get('temp/sibling/H2_gas.traj') is None
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            for i in range(2):
+                structures = list(collect_structures(folder, workers=2,
+                                                     executor=executor))
+                assert [atoms.info for atoms in structures] == \
+                    [atoms.info for atoms in cached]
+
+    def test3_logs(self):
+        shutil.copy('{path}/aayush/MontoyaChallenge2015.db'.format(path=path),
+                    'temp/logs.db')
+        logs = [('OUTCAR', b'OUTCAR ' * 1000),
+                ('vasprun.xml', b'<modeling/>' * 100),
+                ('DOSCAR', b'DOSCAR')]
+        with CathubSQLite('temp/logs.db') as db:
+            cur = db.connection.cursor()
+            cur.execute('SELECT id, unique_id FROM systems LIMIT 1')
+            id, ase_id = cur.fetchone()
+            for logtype, blob in logs:
+                db.write_log(ase_id, logtype, b'old ' + blob)
+                db.write_log(ase_id, logtype, blob)
+            assert sorted(db.read_log(id)) == \
+                sorted([(ase_id, logtype, blob) for logtype, blob in logs])
+
+        db = CathubPostgreSQL(user='postgres')
+        con = db._connect()
+        db._initialize(con)
+        db.truncate_schema()
+        con.commit()
+        con.close()
+        db.transfer('temp/logs.db')
+        assert sorted(db.read_log(ase_id)) == sorted(logs)
 
     def test3_upload(self):
         """Ensure postgres database is empty"""
@@ -113,6 +309,10 @@ class UploadTestCase(unittest.TestCase):
 
         db2server.main('{path}/aayush/MontoyaChallenge2015.db'
                        .format(path=path), user='postgres')
+        n_reactions = db.status('reaction')
+        db2server.main('{path}/aayush/MontoyaChallenge2015.db'
+                       .format(path=path), user='postgres', resume=True)
+        assert db.status('reaction') == n_reactions
         if os.path.exists('{path}/aayush/MontoyaChallenge2015.db'
                           .format(path=path)):
             os.remove('{path}/aayush/MontoyaChallenge2015.db'